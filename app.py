@@ -1,8 +1,25 @@
 import pymysql
+import traffic_capture
 from flask import Flask, jsonify, request
 from flask_socketio import SocketIO, emit, join_room, leave_room
 import gevent
+import gevent.event
+import gevent.events
+import gevent.lock
+import gevent.monkey
+import gevent.queue
+import greenlet
+import base64
+import collections
+import functools
+import hashlib
+import hmac
+import json
+import os
+import sys
 import time
+import tracemalloc
+import uuid
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'secret!'
@@ -18,12 +35,215 @@ socketio = SocketIO(
 # Store active store and client sessions
 store_sessions = {}  # store_code: sid
 client_sessions = {}  # sid: store_code
-pending_logins = {}  # client_sid: (store_code, username, password)
+pending_logins = {}  # client_sid: (store_code, username)
 # For stock requests
-# Change pending_requests to allow multiple requests per client
-# pending_requests: {client_sid: [request_dict, ...]}
-pending_requests = {}  # client_sid: [ {'type': ..., ...}, ... ]
+# pending_requests: {client_sid: deque([PendingRequest, ...])}, at most MAX_PENDING_PER_CLIENT per client
+pending_requests = {}
+# Forwarded requests carry relay_request_id; backends that echo it in the answer are matched exactly
+MAX_PENDING_PER_CLIENT = int(os.environ.get('MAX_PENDING_PER_CLIENT', 64))
+# Request types are stored as small ints; the tuple index is the code
+PENDING_TYPES = (
+    'snapshot', 'products', 'barcode', 'details', 'clients', 'sales', 'sale_details', 'vendeurs',
+    'clients_list', 'get_treasury', 'fournisseurs', 'factures_achat', 'facture_achat_details',
+    'factures_vente', 'facture_vente_details', 'save_vente', 'batch',
+)
+PENDING_TYPE_CODES = {name: code for code, name in enumerate(PENDING_TYPES)}
+
+# Event a client receives the answer (or an error) for each pending request type on
+PENDING_RESPONSE_EVENTS = {
+    'snapshot': 'snapshot_table_data', 'products': 'products_data', 'barcode': 'product_by_barcode_data',
+    'details': 'product_details_data', 'clients': 'clients_data', 'sales': 'sales_data',
+    'sale_details': 'sale_details_data', 'vendeurs': 'vendeurs_data', 'clients_list': 'clients_list_data',
+    'get_treasury': 'treasury_data', 'fournisseurs': 'fournisseurs_data', 'factures_achat': 'factures_achat_data',
+    'facture_achat_details': 'facture_achat_details_data', 'factures_vente': 'factures_vente_data',
+    'facture_vente_details': 'facture_vente_details_data', 'save_vente': 'save_vente_response',
+    'batch': 'batch_data',
+}
+
+def intern_code(code):
+    """Share one string object per store code across sessions and pending requests"""
+    return sys.intern(code) if isinstance(code, str) else code
+
+class PendingRequest(object):
+    """One request forwarded to a store backend and waiting for its answer"""
+    __slots__ = ('kind', 'store_code', 'key', 'extra', 'sent_at', 'request_id')
+
+    def __init__(self, type_name, store_code, key=None, extra=None):
+        self.kind = PENDING_TYPE_CODES[type_name]
+        self.store_code = intern_code(store_code)
+        self.key = key  # matched against the answer when set (snapshot table, batch_id)
+        self.extra = extra
+        self.sent_at = time.time()
+        self.request_id = uuid.uuid4().hex
+
+    @property
+    def type(self):
+        return PENDING_TYPES[self.kind]
+
+    def __repr__(self):
+        return f'<{self.type} {self.store_code}{" " + str(self.key) if self.key is not None else ""}>'
+
+def add_pending_request(client_sid, type_name, store_code, key=None, extra=None):
+    """Track a request about to be sent to the store and return it; returns None (after sending the client
+    an error) when the client already has MAX_PENDING_PER_CLIENT requests waiting, in which case it must not be sent"""
+    req = PendingRequest(type_name, store_code, key, extra)
+    reqs = pending_requests.get(client_sid)
+    if reqs is None:
+        reqs = pending_requests[client_sid] = collections.deque()
+    elif len(reqs) >= MAX_PENDING_PER_CLIENT:
+        print(f"WARNING: client {client_sid} has {MAX_PENDING_PER_CLIENT} pending requests, rejecting {req!r}")
+        send_pending_error(client_sid, req, 'Too many pending requests, try again later')
+        return None
+    reqs.append(req)
+    return req
+
+def with_request_id(data, req):
+    """Payload to forward to the store for req, tagged with its relay_request_id"""
+    if data is None or isinstance(data, dict):
+        return dict(data or {}, relay_request_id=req.request_id)
+    return data
+
+def echoed_request_id(data):
+    return data.get('relay_request_id') if isinstance(data, dict) else None
+
+def pop_pending_request(type_name, client_sid=None, key=None, request_id=None):
+    """Remove and return (client_sid, PendingRequest) for the request sent to the store backend whose answer
+    is being handled (request.sid), or (None, None). An answer echoing relay_request_id only matches that request,
+    so a late answer to a request that timed out or whose client left is dropped. Without the echo the oldest
+    matching request is taken; without client_sid every client is considered."""
+    store_code = get_store_code_for_sid(request.sid)
+    if store_code is None:
+        return None, None
+    kind = PENDING_TYPE_CODES[type_name]
+    best_sid, best = None, None
+    candidates = [(client_sid, pending_requests.get(client_sid))] if client_sid else list(pending_requests.items())
+    for csid, reqs in candidates:
+        for req in reqs or ():
+            if req.kind == kind and req.store_code == store_code and (key is None or req.key == key):
+                if request_id is not None:
+                    if req.request_id == request_id:
+                        best_sid, best = csid, req
+                        break
+                    continue
+                # Each deque is oldest first
+                if best is None or req.sent_at < best.sent_at:
+                    best_sid, best = csid, req
+                break
+        if best is not None and request_id is not None:
+            break
+    if best is None:
+        if request_id is not None:
+            print(f"API: dropping {type_name} answer to unknown request {request_id} from store {store_code}")
+        return None, None
+    reqs = pending_requests[best_sid]
+    reqs.remove(best)
+    if not reqs:
+        del pending_requests[best_sid]
+    get_store_breaker(store_code).record(best.type, True, time.time() - best.sent_at)
+    return best_sid, best
+
+def fail_store_pending_requests(store_code, error):
+    """The store connection is gone: nothing sent on it will be answered"""
+    for client_sid, reqs in list(pending_requests.items()):
+        for req in [req for req in reqs if req.store_code == store_code]:
+            reqs.remove(req)
+            send_pending_error(client_sid, req, error)
+        if not reqs:
+            pending_requests.pop(client_sid, None)
+
+def send_pending_error(client_sid, req, error):
+    """Answer a pending request with an error, in the shape its response event uses"""
+    if req.type == 'batch':
+        items, failed = req.extra
+        payload = {'batch_id': req.key, 'error': error, 'results': build_batch_results(items, failed, {}, error)}
+    elif req.type == 'snapshot':
+        payload = {'error': error, 'table': req.key}
+    else:
+        payload = {'success': False, 'error': error}
+    socketio.emit(PENDING_RESPONSE_EVENTS[req.type], payload, room=client_sid)
 # --- OFFLINE SNAPSHOT RELAY ---
+# Snapshot pages are sized from measured throughput: the store's rows/s (store answer time) and the
+# client's rows/s (time from delivering a page until it asks for the next), aiming at
+# SNAPSHOT_PAGE_SECONDS per page. 'recommend' adds recommended_limit to each page, 'enforce' also
+# overrides the client's limit, 'off' relays limits untouched. Every page carries the offset and limit
+# it was fetched with. While the client consumes a full page the next one is prefetched at the client's
+# limit (the recommended size under 'enforce') and served from memory to the next request for that page;
+# only 'enforce' serves it whatever limit was asked, since there the client's limit is overridden anyway.
+SNAPSHOT_PAGE_SIZING = os.environ.get('SNAPSHOT_PAGE_SIZING', 'recommend')  # 'recommend', 'enforce' or 'off'
+SNAPSHOT_PAGE_SECONDS = float(os.environ.get('SNAPSHOT_PAGE_SECONDS', 2))  # target time per page
+SNAPSHOT_DEFAULT_LIMIT = 1000
+SNAPSHOT_MIN_LIMIT = int(os.environ.get('SNAPSHOT_MIN_LIMIT', 100))
+SNAPSHOT_MAX_LIMIT = int(os.environ.get('SNAPSHOT_MAX_LIMIT', 10000))
+SNAPSHOT_PREFETCH = os.environ.get('SNAPSHOT_PREFETCH', '1') == '1'
+SNAPSHOT_PREFETCH_TTL = 30  # seconds a prefetched page is kept for its client
+snapshot_store_rates = {}  # store_code: EWMA rows/s served by the store
+snapshot_client_rates = {}  # client_sid: EWMA rows/s consumed by the client
+# (client_sid, table): {'fetches': deque([[offset, limit, sent_at, prefetch]]), 'prefetched': (offset, limit, data, at),
+#                       'waiting': offset the client asked for while it was being prefetched, 'delivered': (at, rows)}
+snapshot_streams = {}
+
+def update_rate(rates, key, rows, seconds):
+    if rows and seconds > 0:
+        rate = rows / seconds
+        rates[key] = rate if key not in rates else 0.7 * rates[key] + 0.3 * rate
+
+def recommended_snapshot_limit(client_sid, store_code):
+    """Page size expected to take SNAPSHOT_PAGE_SECONDS for the slower of store and client"""
+    rates = [r for r in (snapshot_store_rates.get(store_code), snapshot_client_rates.get(client_sid)) if r]
+    if not rates:
+        return SNAPSHOT_DEFAULT_LIMIT
+    limit = int(min(rates) * SNAPSHOT_PAGE_SECONDS) // 50 * 50
+    return max(SNAPSHOT_MIN_LIMIT, min(SNAPSHOT_MAX_LIMIT, limit))
+
+def snapshot_rows(data):
+    """Number of rows in a snapshot page, or None if the payload has no recognizable row list"""
+    for field in ('rows', 'data', 'records'):
+        if isinstance(data.get(field), list):
+            return len(data[field])
+    return None
+
+def fetch_snapshot_page(client_sid, store_code, table, offset, limit, prefetch=False):
+    stream = snapshot_streams.setdefault((client_sid, table), {'fetches': collections.deque(), 'prefetched': None,
+                                                                'waiting': None, 'delivered': None})
+    now = time.time()
+    while stream['fetches'] and now - stream['fetches'][0][2] > STORE_REQUEST_TIMEOUT:
+        stream['fetches'].popleft()  # never answered
+    stream['fetches'].append([offset, limit, now, prefetch])
+    payload = {'client_sid': client_sid, 'table': table, 'offset': offset, 'limit': limit}
+    socketio.emit('get_snapshot_table', payload, room=store_sessions[store_code])
+
+def prefetch_next_snapshot_page(client_sid, store_code, table, offset, limit, rows, data):
+    """Ask the store for the page after a full one, unless the store is struggling"""
+    if not SNAPSHOT_PREFETCH or rows is None or rows < limit or data.get('has_more') is False:
+        return
+    breaker = get_store_breaker(store_code)
+    if store_code not in store_sessions or breaker.state != 'closed' or breaker.health() < STORE_SHED_BELOW:
+        return
+    next_limit = recommended_snapshot_limit(client_sid, store_code) if SNAPSHOT_PAGE_SIZING == 'enforce' else limit
+    fetch_snapshot_page(client_sid, store_code, table, offset + limit, next_limit, prefetch=True)
+
+def prefetch_usable(offset, limit, prefetched_offset, prefetched_limit):
+    """A prefetched page answers a request at the same offset; its limit has to match unless sizing is enforced"""
+    return prefetched_offset == offset and (SNAPSHOT_PAGE_SIZING == 'enforce' or prefetched_limit == limit)
+
+def deliver_snapshot_page(client_sid, store_code, table, offset, limit, data):
+    stream = snapshot_streams.get((client_sid, table))
+    rows = snapshot_rows(data)
+    # The limit actually applied, so a page shorter than the client asked for is not taken for the last one
+    data = dict(data, offset=offset, limit=limit)
+    if SNAPSHOT_PAGE_SIZING != 'off':
+        data = dict(data, recommended_limit=recommended_snapshot_limit(client_sid, store_code))
+    if stream is not None:
+        stream['delivered'] = (time.time(), rows)
+    socketio.emit('snapshot_table_data', data, room=client_sid)
+    if stream is not None and not data.get('error'):
+        prefetch_next_snapshot_page(client_sid, store_code, table, offset, limit, rows, data)
+
+def clear_snapshot_streams(client_sid):
+    snapshot_client_rates.pop(client_sid, None)
+    for key in [key for key in snapshot_streams if key[0] == client_sid]:
+        del snapshot_streams[key]
+
 @socketio.on('get_snapshot_table')
 def handle_get_snapshot_table(data):
     client_sid = request.sid
@@ -36,18 +256,36 @@ def handle_get_snapshot_table(data):
     if not store_sid:
         emit('snapshot_table_data', {'error': 'Store backend not connected', 'table': table})
         return
-    if client_sid not in pending_requests:
-        pending_requests[client_sid] = []
-    if isinstance(pending_requests[client_sid], dict):
-        pending_requests[client_sid] = [pending_requests[client_sid]]
-    pending_requests[client_sid].append({'type': 'snapshot', 'store_code': store_code, 'table': table})
-    payload = {
-        'client_sid': client_sid,
-        'table': table,
-        'offset': int((data or {}).get('offset', 0)),
-        'limit': int((data or {}).get('limit', 1000)),
-    }
-    socketio.emit('get_snapshot_table', payload, room=store_sid)
+    offset = int((data or {}).get('offset', 0))
+    limit = int((data or {}).get('limit', SNAPSHOT_DEFAULT_LIMIT))
+    if SNAPSHOT_PAGE_SIZING == 'enforce':
+        limit = recommended_snapshot_limit(client_sid, store_code)
+    stream = snapshot_streams.get((client_sid, table))
+    if stream is not None:
+        # Time spent on the previous page measures how fast this client takes rows
+        if stream['delivered']:
+            delivered_at, rows = stream['delivered']
+            update_rate(snapshot_client_rates, client_sid, rows, time.time() - delivered_at)
+            stream['delivered'] = None
+        prefetched = stream['prefetched']
+        stream['prefetched'] = None
+        if prefetched and prefetch_usable(offset, limit, prefetched[0], prefetched[1]) \
+                and time.time() - prefetched[3] < SNAPSHOT_PREFETCH_TTL:
+            deliver_snapshot_page(client_sid, store_code, table, offset, prefetched[1], prefetched[2])
+            return
+        if any(f[3] and prefetch_usable(offset, limit, f[0], f[1]) and time.time() - f[2] < STORE_REQUEST_TIMEOUT
+               for f in stream['fetches']):
+            # Already on its way from the store; answer when it lands
+            if add_pending_request(client_sid, 'snapshot', store_code, key=table):
+                stream['waiting'] = offset
+            return
+    error = check_store_admission(store_code, 'snapshot')
+    if error:
+        emit('snapshot_table_data', {'error': error, 'table': table})
+        return
+    if not add_pending_request(client_sid, 'snapshot', store_code, key=table):
+        return
+    fetch_snapshot_page(client_sid, store_code, table, offset, limit)
 
 @socketio.on('snapshot_table_data')
 def handle_snapshot_table_data(data):
@@ -55,28 +293,194 @@ def handle_snapshot_table_data(data):
     client_sid = (data or {}).get('client_sid')
     if not client_sid:
         # Fallback: deliver to first snapshot requester
-        for csid, reqs in list(pending_requests.items()):
-            for i, req in enumerate(reqs):
-                if req.get('type') == 'snapshot' and req.get('table') == table:
-                    socketio.emit('snapshot_table_data', data, room=csid)
-                    del pending_requests[csid][i]
-                    if not pending_requests[csid]:
-                        del pending_requests[csid]
-                    return
-        return
-    # Route directly to requesting client
-    socketio.emit('snapshot_table_data', data, room=client_sid)
+        csid, _ = pop_pending_request('snapshot', key=table)
+        if csid:
+            socketio.emit('snapshot_table_data', data, room=csid)
+        return
+    stream = snapshot_streams.get((client_sid, table))
+    if not stream or not stream['fetches']:
+        # Route directly to requesting client
+        pop_pending_request('snapshot', client_sid=client_sid, key=table)
+        socketio.emit('snapshot_table_data', data, room=client_sid)
+        return
+    fetches = stream['fetches']
+    fetch = next((f for f in fetches if f[0] == data.get('offset')), fetches[0])
+    fetches.remove(fetch)
+    offset, limit, sent_at, prefetch = fetch
+    store_code = client_sessions.get(client_sid)
+    update_rate(snapshot_store_rates, store_code, snapshot_rows(data), time.time() - sent_at)
+    if prefetch and stream['waiting'] != offset:
+        # Nobody asked yet: keep it for the client's next request
+        get_store_breaker(store_code).record('snapshot', True, time.time() - sent_at)
+        if not data.get('error'):
+            stream['prefetched'] = (offset, limit, data, time.time())
+        return
+    stream['waiting'] = None
+    pop_pending_request('snapshot', client_sid=client_sid, key=table)
+    deliver_snapshot_page(client_sid, store_code, table, offset, limit, data)
 
 
 # --- DB connection helper ---
+API_DB_POOL_SIZE = int(os.environ.get('API_DB_POOL_SIZE', 4))  # idle connections kept open
+API_DB_IDLE_PING = 30  # seconds idle before a pooled connection is pinged on checkout
+api_db_pool = gevent.queue.LifoQueue()  # (connection, returned_at)
+
+class PooledConnection(object):
+    """pymysql connection whose close() hands it back to api_db_pool instead of closing it"""
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        try:
+            # End any open transaction so the next user does not read a stale snapshot
+            conn.rollback()
+            if api_db_pool.qsize() < API_DB_POOL_SIZE:
+                api_db_pool.put((conn, time.time()))
+                return
+        except Exception:
+            pass
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+def connect_api_db():
+    # For API store authentication, connect to the 'stores' database (env overrides let a local instance use a local MySQL)
+    return pymysql.connect(host=os.environ.get('API_DB_HOST', 'db4free.net'),
+                           user=os.environ.get('API_DB_USER', 'vmmachine03'),
+                           password=os.environ.get('API_DB_PASSWORD', 'vmmachine03'),
+                           database=os.environ.get('API_DB_NAME', 'vmmachine03'))
+
 def get_api_db_connection():
-    # For API store authentication, connect to the 'stores' database
-    return pymysql.connect(host='db4free.net', user='vmmachine03', password='vmmachine03', database='vmmachine03')
+    while not api_db_pool.empty():
+        conn, returned_at = api_db_pool.get_nowait()
+        try:
+            if time.time() - returned_at > API_DB_IDLE_PING:
+                conn.ping(reconnect=False)
+            return PooledConnection(conn)
+        except Exception:
+            try:
+                conn.close()
+            except Exception:
+                pass
+    return PooledConnection(connect_api_db())
+
+# --- STORE METADATA INDEX ---
+# Whole stores table kept in memory so reconnect storms are served without a SELECT per store/client.
+# register_store trusts a matching cached auth hash, so a rotated or revoked auth_code keeps working
+# until the next refresh (STORE_INDEX_REFRESH); after changing credentials, POST /admin/store_index/refresh.
+STORE_INDEX_REFRESH = int(os.environ.get('STORE_INDEX_REFRESH', 300))  # seconds
+store_index = {}  # store_code: {'auth_hash': sha256 hex of auth_code or None, 'name': ...}
+worker_ready = False
+
+def hash_auth_code(auth_code):
+    return hashlib.sha256(str(auth_code).encode()).hexdigest()
+
+def load_store_index():
+    """Stream the stores table in one query and swap in the new index; returns the row count"""
+    global store_index
+    index = {}
+    conn = get_api_db_connection()
+    try:
+        with conn.cursor(pymysql.cursors.SSCursor) as cursor:
+            cursor.execute("SELECT store_code, auth_code, name FROM stores")
+            for store_code, auth_code, name in cursor:
+                index[store_code] = {'auth_hash': hash_auth_code(auth_code) if auth_code else None, 'name': name or ""}
+    finally:
+        conn.close()
+    store_index = index
+    return len(index)
+
+def get_store_name(store_code):
+    entry = store_index.get(store_code)
+    if entry is not None:
+        return entry['name']
+    try:
+        conn = get_api_db_connection()
+        with conn.cursor() as cursor:
+            sql = "SELECT name FROM stores WHERE store_code=%s LIMIT 1"
+            cursor.execute(sql, (store_code,))
+            row = cursor.fetchone()
+        conn.close()
+        return (row[0] or "") if row else ""
+    except Exception:
+        return ""
+
+def warm_start():
+    """Pre-open DB connections and preload the store index before the worker reports ready"""
+    global worker_ready
+    started = time.time()
+    opened = 0
+    try:
+        conns = [get_api_db_connection() for _ in range(API_DB_POOL_SIZE)]
+        opened = len(conns)
+        for conn in conns:
+            conn.close()
+        rows = load_store_index()
+        print(f"Warm start: preloaded {rows} stores, opened {opened} DB connections in {time.time() - started:.2f}s")
+    except Exception as e:
+        print(f"Warm start failed after {time.time() - started:.2f}s ({opened} DB connections opened), "
+              f"falling back to per-request queries: {e}")
+    try:
+        create_ticket_revocations_table()
+        load_ticket_revocations()
+    except Exception as e:
+        print(f"Could not load session_ticket_revocations table: {e}")
+    worker_ready = True
+
+def refresh_store_index():
+    """Periodically reload the store index so auth code and name changes are picked up"""
+    while True:
+        gevent.sleep(STORE_INDEX_REFRESH)
+        try:
+            load_store_index()
+        except Exception as e:
+            print(f"Error refreshing store index: {e}")
+        try:
+            load_ticket_revocations()
+        except Exception as e:
+            print(f"Error refreshing session ticket revocations: {e}")
+
+# Admin endpoints are disabled unless ADMIN_TOKEN is set; callers send it in the X-Admin-Token header
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+
+def admin_authorized():
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN)
+
+@app.route('/admin/store_index/refresh', methods=['POST'])
+def post_store_index_refresh():
+    """Reload the store index and ticket revocations now, e.g. right after an auth_code was rotated or revoked"""
+    if not admin_authorized():
+        return jsonify({'error': 'Forbidden'}), 403
+    try:
+        rows = load_store_index()
+    except Exception as e:
+        # Drop the cache so register_store checks every store against the database
+        store_index.clear()
+        return jsonify({'error': f'Reload failed, index cleared: {e}'}), 500
+    try:
+        revocations = load_ticket_revocations()
+    except Exception as e:
+        return jsonify({'stores_indexed': rows, 'error': f'Session ticket revocations not reloaded: {e}'}), 500
+    return jsonify({'stores_indexed': rows, 'ticket_revocations': revocations})
 
 @app.route('/')
 def index():
     return jsonify({'message': 'API is running'})
 
+@app.route('/api/ready')
+def get_ready():
+    """Readiness probe: 503 until warm start has finished"""
+    if not worker_ready:
+        return jsonify({'ready': False}), 503
+    return jsonify({'ready': True, 'stores_indexed': len(store_index)})
+
 @app.route('/api/store_status/<store_code>')
 def get_store_status(store_code):
     """REST endpoint to check store status (ONLINE or OFFLINE)"""
@@ -103,39 +507,45 @@ def handle_register_store(data):
     if not store_code or not auth_code:
         emit('register_store_response', {'success': False, 'error': 'Missing store code or auth code'})
         return
-    # Check credentials in the API database
-    try:
-        conn = get_api_db_connection()
-        with conn.cursor() as cursor:
-            sql = "SELECT id FROM stores WHERE store_code=%s AND auth_code=%s LIMIT 1"
-            cursor.execute(sql, (store_code, auth_code))
-            row = cursor.fetchone()
-        conn.close()
-        if not row:
-            emit('register_store_response', {'success': False, 'error': 'Invalid store code or auth code'})
+    # Check credentials against the preloaded index, falling back to the API database on a miss
+    entry = store_index.get(store_code)
+    if not (entry and entry['auth_hash'] and hmac.compare_digest(entry['auth_hash'], hash_auth_code(auth_code))):
+        try:
+            conn = get_api_db_connection()
+            with conn.cursor() as cursor:
+                sql = "SELECT name FROM stores WHERE store_code=%s AND auth_code=%s LIMIT 1"
+                cursor.execute(sql, (store_code, auth_code))
+                row = cursor.fetchone()
+            conn.close()
+            if not row:
+                emit('register_store_response', {'success': False, 'error': 'Invalid store code or auth code'})
+                return
+            store_index[store_code] = {'auth_hash': hash_auth_code(auth_code), 'name': row[0] or ""}
+        except Exception as e:
+            emit('register_store_response', {'success': False, 'error': f'Database error: {e}'})
             return
-    except Exception as e:
-        emit('register_store_response', {'success': False, 'error': f'Database error: {e}'})
-        return
+    if store_sessions.get(store_code) != request.sid:
+        # Requests sent on a previous connection will never be answered
+        fail_store_pending_requests(store_code, 'Store backend reconnected')
     # Always update to latest sid so reconnect rebinds correctly
     store_sessions[store_code] = request.sid
-    join_room(store_code)
+    reset_vente_inflight(store_code)
+    # A new connection starts with a clean breaker
+    store_breakers.pop(store_code, None)
+    # Users may have changed while the backend was away; warm the login screen list again
+    usernames_cache.pop(store_code, None)
+    # Backends get their own room; the store_code room is for clients only
+    join_room(backend_room(store_code))
     # Initialize activity tracking (use current time) - heartbeats will keep this updated
     update_store_activity(store_code)
-    # Update store status to ONLINE in database
-    try:
-        conn = get_api_db_connection()
-        with conn.cursor() as cursor:
-            sql = "UPDATE stores SET status='ONLINE' WHERE store_code=%s"
-            cursor.execute(sql, (store_code,))
-            conn.commit()
-        conn.close()
-    except Exception as e:
-        print(f"Error updating store status to ONLINE: {e}")
     emit('register_store_response', {'success': True, 'store_code': store_code})
     print(f"Store registered: {store_code}, sid: {request.sid}, activity initialized at {store_last_activity.get(store_code, 'unknown')}")
-    # Notify all clients bound to this store that backend is online
-    socketio.emit('store_online', {'store_code': store_code}, room=store_code)
+    # Status ONLINE in database and store_online to clients, once the debounce window settles
+    set_store_presence(store_code, True)
+    # Deliver sales journaled while the store was unreachable
+    replay_vente_journal(store_code)
+    # Clients that were waiting on the previous connection are carried over
+    request_usernames(store_code, force=True)
 
 @socketio.on('register_client')
 def handle_register_client(data):
@@ -144,18 +554,9 @@ def handle_register_client(data):
         emit('register_client_response', {'success': False, 'error': 'Missing store code'})
         return
     # Allow client to register even if backend currently offline; it will receive errors per-request
-    try:
-        conn = get_api_db_connection()
-        with conn.cursor() as cursor:
-            sql = "SELECT name FROM stores WHERE store_code=%s LIMIT 1"
-            cursor.execute(sql, (store_code,))
-            row = cursor.fetchone()
-        conn.close()
-        store_name = row[0] if row else ""
-    except Exception as e:
-        store_name = ""
+    store_name = get_store_name(store_code)
     # Then, when emitting register_client_response or login_result:
-    client_sessions[request.sid] = store_code
+    client_sessions[request.sid] = intern_code(store_code)
     join_room(store_code)
     emit('register_client_response', {'success': True, 'store_code': store_code, 'store_name': store_name})
     print(f"Client registered for store: {store_code}, sid: {request.sid}")
@@ -178,8 +579,8 @@ def handle_login(data):
     if not store_sid:
         emit('login_result', {'success': False, 'error': 'Store backend not connected'})
         return
-    # Save pending login to match response
-    pending_logins[client_sid] = (store_code, username, password)
+    # Save pending login to match response (the password is only forwarded, never kept)
+    pending_logins[client_sid] = (store_code, username)
     # Forward login request to Windows backend
     socketio.emit('login_request', {
         'client_sid': client_sid,
@@ -201,34 +602,179 @@ def handle_login_response(data):
         return
     # Get store_code from pending_logins
     store_code = None
+    username = None
     if client_sid in pending_logins:
-        store_code = pending_logins[client_sid][0]
+        store_code, username = pending_logins[client_sid]
+        if store_sessions.get(store_code) != request.sid:
+            print(f"API: Ignoring login_response for client {client_sid} from a backend other than store '{store_code}'")
+            return
     # Relay result to Android client
-    # After verifying store_code and auth_code:
-    try:
-        store_name = ""
-        if store_code:
-            conn = get_api_db_connection()
-            with conn.cursor() as cursor:
-                sql = "SELECT name FROM stores WHERE store_code=%s LIMIT 1"
-                cursor.execute(sql, (store_code,))
-                row = cursor.fetchone()
-            conn.close()
-            store_name = row[0] if row else ""
-    except Exception as e:
-        store_name = ""
+    store_name = get_store_name(store_code) if store_code else ""
     print(f"API: Emitting login_result to client {client_sid}: success={success}, error={error}")
-    socketio.emit('login_result', {
+    result = {
         'success': success,
         'error': error,
         'user_info': user_info,
         'store_name': store_name
-    }, room=client_sid)
+    }
+    if success and store_code and username:
+        # Reconnects can present this ticket via resume_session instead of logging in again
+        result['session_ticket'] = issue_session_ticket(store_code, username, user_info, store_name)
+    socketio.emit('login_result', result, room=client_sid)
     print(f"API: Relayed login result to client {client_sid}: {success}, {error}")
     # Remove from pending
     if client_sid in pending_logins:
         del pending_logins[client_sid]
 
+# --- SESSION TICKETS ---
+# Signed, expiring tickets issued after a successful login so reconnects are validated locally.
+# Set SESSION_TICKET_SECRET to keep tickets valid across restarts and workers. Revocations are stored
+# in the session_ticket_revocations table and loaded into memory at warm start and with every store index
+# refresh, so resume never touches the database. A revocation made on another worker takes effect here
+# within STORE_INDEX_REFRESH (or at once via POST /admin/store_index/refresh).
+SESSION_TICKET_SECRET = os.environ.get('SESSION_TICKET_SECRET', '').encode() or os.urandom(32)
+SESSION_TICKET_TTL = int(os.environ.get('SESSION_TICKET_TTL', 12 * 3600))  # seconds
+store_ticket_revocations = {}  # store_code: tickets issued at or before this timestamp are revoked
+user_ticket_revocations = {}  # (store_code, username): same, for a single user
+# username '' revokes every ticket of the store
+TICKET_REVOCATIONS_TABLE_SQL = """CREATE TABLE IF NOT EXISTS session_ticket_revocations (
+    store_code VARCHAR(64) NOT NULL,
+    username VARCHAR(191) NOT NULL DEFAULT '',
+    revoked_at DOUBLE NOT NULL,
+    PRIMARY KEY (store_code, username)
+)"""
+
+def create_ticket_revocations_table():
+    conn = get_api_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(TICKET_REVOCATIONS_TABLE_SQL)
+        conn.commit()
+    finally:
+        conn.close()
+
+def save_ticket_revocation(store_code, username, revoked_at):
+    conn = get_api_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO session_ticket_revocations (store_code, username, revoked_at) VALUES (%s, %s, %s) "
+                "ON DUPLICATE KEY UPDATE revoked_at=GREATEST(revoked_at, VALUES(revoked_at))",
+                (store_code, username or '', revoked_at))
+        conn.commit()
+    finally:
+        conn.close()
+
+def load_ticket_revocations():
+    """Merge the revocations table into memory (keeping newer local ones); returns the row count"""
+    conn = get_api_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT store_code, username, revoked_at FROM session_ticket_revocations")
+            rows = cursor.fetchall()
+    finally:
+        conn.close()
+    for store_code, username, revoked_at in rows:
+        if username:
+            key = (store_code, username)
+            user_ticket_revocations[key] = max(user_ticket_revocations.get(key, 0), revoked_at)
+        else:
+            store_ticket_revocations[store_code] = max(store_ticket_revocations.get(store_code, 0), revoked_at)
+    return len(rows)
+
+def get_ticket_revocation(store_code, username):
+    """Latest revocation time covering this user's tickets"""
+    return max(store_ticket_revocations.get(store_code, 0), user_ticket_revocations.get((store_code, username), 0))
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+def issue_session_ticket(store_code, username, user_info, store_name):
+    """Return a signed ticket carrying everything needed to answer a later resume_session"""
+    now = time.time()
+    claims = {
+        'store_code': store_code,
+        'username': username,
+        'user_info': user_info,
+        'store_name': store_name,
+        'iat': now,
+        'exp': now + SESSION_TICKET_TTL,
+    }
+    body = _b64encode(json.dumps(claims, separators=(',', ':')).encode())
+    signature = hmac.new(SESSION_TICKET_SECRET, body.encode(), hashlib.sha256).digest()
+    return f'{body}.{_b64encode(signature)}'
+
+def verify_session_ticket(ticket):
+    """Return (claims, None) for a valid ticket, or (None, error)"""
+    try:
+        body, signature = ticket.split('.', 1)
+        expected = hmac.new(SESSION_TICKET_SECRET, body.encode(), hashlib.sha256).digest()
+        if not hmac.compare_digest(expected, _b64decode(signature)):
+            return None, 'Invalid session ticket'
+        claims = json.loads(_b64decode(body))
+    except Exception:
+        return None, 'Invalid session ticket'
+    if claims.get('exp', 0) < time.time():
+        return None, 'Session ticket expired'
+    if claims.get('iat', 0) <= get_ticket_revocation(claims.get('store_code'), claims.get('username')):
+        return None, 'Session ticket revoked'
+    return claims, None
+
+@socketio.on('resume_session')
+def handle_resume_session(data):
+    # data: {'ticket': ..., 'store_code': optional, must match the ticket}
+    ticket = (data or {}).get('ticket')
+    if not ticket or not isinstance(ticket, str):
+        emit('login_result', {'success': False, 'error': 'Missing session ticket'})
+        return
+    claims, error = verify_session_ticket(ticket)
+    if not error and data.get('store_code') and data.get('store_code') != claims['store_code']:
+        error = 'Session ticket is for another store'
+    if error:
+        emit('login_result', {'success': False, 'error': error})
+        return
+    store_code = claims['store_code']
+    client_sessions[request.sid] = intern_code(store_code)
+    join_room(store_code)
+    emit('login_result', {
+        'success': True,
+        'error': None,
+        'user_info': claims.get('user_info'),
+        'store_name': claims.get('store_name', ''),
+        'resumed': True
+    })
+    print(f"API: Resumed session for user '{claims.get('username')}' on store '{store_code}', sid: {request.sid}")
+    if store_code not in store_sessions:
+        socketio.emit('store_offline', {'store_code': store_code}, room=request.sid)
+
+@socketio.on('revoke_session_tickets')
+def handle_revoke_session_tickets(data):
+    # Sent by a store backend: data {'username': optional}; without a username every ticket of the store is revoked
+    update_activity_for_session()
+    store_code = get_store_code_for_sid(request.sid)
+    if not store_code:
+        emit('revoke_session_tickets_response', {'success': False, 'error': 'Not registered as a store'})
+        return
+    username = (data or {}).get('username')
+    revoked_at = time.time()
+    if username:
+        user_ticket_revocations[(store_code, username)] = revoked_at
+    else:
+        store_ticket_revocations[store_code] = revoked_at
+    try:
+        save_ticket_revocation(store_code, username, revoked_at)
+    except Exception as e:
+        # Still enforced by this worker until it restarts
+        print(f"Error saving session ticket revocation for store '{store_code}': {e}")
+        emit('revoke_session_tickets_response', {'success': False, 'store_code': store_code, 'username': username,
+                                                 'error': f'Revocation not persisted: {e}'})
+        return
+    emit('revoke_session_tickets_response', {'success': True, 'store_code': store_code, 'username': username})
+    print(f"API: Revoked session tickets for store '{store_code}'" + (f", user '{username}'" if username else ''))
+
 # --- STOCK RELAY HANDLERS ---
 @socketio.on('get_products')
 def handle_get_products(data):
@@ -241,13 +787,15 @@ def handle_get_products(data):
     if not store_sid:
         emit('products_data', {'error': 'Store backend not connected'})
         return
-    if client_sid not in pending_requests:
-        pending_requests[client_sid] = []
-    if isinstance(pending_requests[client_sid], dict):
-        pending_requests[client_sid] = [pending_requests[client_sid]]
-    pending_requests[client_sid].append({'type': 'products', 'store_code': store_code})
-    print(f'API: pending_requests after get_products: {pending_requests}')
-    socketio.emit('get_products', data, room=store_sid)
+    error = check_store_admission(store_code, 'products')
+    if error:
+        emit('products_data', {'error': error})
+        return
+    req = add_pending_request(client_sid, 'products', store_code)
+    if req is None:
+        return
+    print(f'API: pending_requests after get_products: {pending_requests[client_sid]}')
+    socketio.emit('get_products', with_request_id(data, req), room=store_sid)
 
 # --- BARCODE RELAY HANDLERS ---
 @socketio.on('get_product_by_barcode')
@@ -261,48 +809,32 @@ def handle_get_product_by_barcode(data):
     if not store_sid:
         emit('product_by_barcode_data', {'success': False, 'error': 'Store backend not connected'})
         return
-    if client_sid not in pending_requests:
-        pending_requests[client_sid] = []
-    if isinstance(pending_requests[client_sid], dict):
-        pending_requests[client_sid] = [pending_requests[client_sid]]
-    pending_requests[client_sid].append({'type': 'barcode', 'store_code': store_code})
-    print(f'API: pending_requests after get_product_by_barcode: {pending_requests}')
-    socketio.emit('get_product_by_barcode', data, room=store_sid)
+    error = check_store_admission(store_code, 'barcode')
+    if error:
+        emit('product_by_barcode_data', {'success': False, 'error': error})
+        return
+    req = add_pending_request(client_sid, 'barcode', store_code)
+    if req is None:
+        return
+    print(f'API: pending_requests after get_product_by_barcode: {pending_requests[client_sid]}')
+    socketio.emit('get_product_by_barcode', with_request_id(data, req), room=store_sid)
 
 @socketio.on('product_by_barcode_data')
 def handle_product_by_barcode_data(data):
     update_activity_for_session()
-    print(f'API: product_by_barcode_data received, pending_requests={pending_requests}')
-    for client_sid, reqs in list(pending_requests.items()):
-        if not isinstance(reqs, list):
-            print(f"WARNING: pending_requests[{client_sid}] is not a list, skipping: {reqs}")
-            continue
-        for i, req in enumerate(reqs):
-            if req['type'] == 'barcode':
-                print(f'API: relaying product_by_barcode_data to client_sid={client_sid}')
-                # Payload may contain only {'success': True, 'name': '...'} now
-                socketio.emit('product_by_barcode_data', data, room=client_sid)
-                del pending_requests[client_sid][i]
-                if not pending_requests[client_sid]:
-                    del pending_requests[client_sid]
-                return
+    client_sid, _ = pop_pending_request('barcode', request_id=echoed_request_id(data))
+    if client_sid:
+        print(f'API: relaying product_by_barcode_data to client_sid={client_sid}')
+        # Payload may contain only {'success': True, 'name': '...'} now
+        socketio.emit('product_by_barcode_data', data, room=client_sid)
 
 @socketio.on('products_data')
 def handle_products_data(data):
     update_activity_for_session()
-    print(f'API: products_data received, pending_requests={pending_requests}')
-    for client_sid, reqs in list(pending_requests.items()):
-        if not isinstance(reqs, list):
-            print(f"WARNING: pending_requests[{client_sid}] is not a list, skipping: {reqs}")
-            continue
-        for i, req in enumerate(reqs):
-            if req['type'] == 'products':
-                print(f'API: relaying products_data to client_sid={client_sid}')
-                socketio.emit('products_data', data, room=client_sid)
-                del pending_requests[client_sid][i]
-                if not pending_requests[client_sid]:
-                    del pending_requests[client_sid]
-                return
+    client_sid, _ = pop_pending_request('products', request_id=echoed_request_id(data))
+    if client_sid:
+        print(f'API: relaying products_data to client_sid={client_sid}')
+        socketio.emit('products_data', data, room=client_sid)
 
 @socketio.on('get_product_details')
 def handle_get_product_details(data):
@@ -316,30 +848,23 @@ def handle_get_product_details(data):
     if not store_sid:
         emit('product_details_data', {'error': 'Store backend not connected'})
         return
-    if client_sid not in pending_requests:
-        pending_requests[client_sid] = []
-    if isinstance(pending_requests[client_sid], dict):
-        pending_requests[client_sid] = [pending_requests[client_sid]]
-    pending_requests[client_sid].append({'type': 'details', 'store_code': store_code, 'np': np})
-    print(f'API: pending_requests after get_product_details: {pending_requests}')
-    socketio.emit('get_product_details', {'np': np}, room=store_sid)
+    error = check_store_admission(store_code, 'details')
+    if error:
+        emit('product_details_data', {'error': error})
+        return
+    req = add_pending_request(client_sid, 'details', store_code)
+    if req is None:
+        return
+    print(f'API: pending_requests after get_product_details: {pending_requests[client_sid]}')
+    socketio.emit('get_product_details', with_request_id({'np': np}, req), room=store_sid)
 
 @socketio.on('product_details_data')
 def handle_product_details_data(data):
     update_activity_for_session()
-    print(f'API: product_details_data received, pending_requests={pending_requests}')
-    for client_sid, reqs in list(pending_requests.items()):
-        if not isinstance(reqs, list):
-            print(f"WARNING: pending_requests[{client_sid}] is not a list, skipping: {reqs}")
-            continue
-        for i, req in enumerate(reqs):
-            if req['type'] == 'details':
-                print(f'API: relaying product_details_data to client_sid={client_sid}')
-                socketio.emit('product_details_data', data, room=client_sid)
-                del pending_requests[client_sid][i]
-                if not pending_requests[client_sid]:
-                    del pending_requests[client_sid]
-                return
+    client_sid, _ = pop_pending_request('details', request_id=echoed_request_id(data))
+    if client_sid:
+        print(f'API: relaying product_details_data to client_sid={client_sid}')
+        socketio.emit('product_details_data', data, room=client_sid)
 
 @socketio.on('get_clients')
 def handle_get_clients(data):
@@ -352,30 +877,23 @@ def handle_get_clients(data):
     if not store_sid:
         emit('clients_data', {'error': 'Store backend not connected'})
         return
-    if client_sid not in pending_requests:
-        pending_requests[client_sid] = []
-    if isinstance(pending_requests[client_sid], dict):
-        pending_requests[client_sid] = [pending_requests[client_sid]]
-    pending_requests[client_sid].append({'type': 'clients', 'store_code': store_code})
-    print(f'API: pending_requests after get_clients: {pending_requests}')
-    socketio.emit('get_clients', data, room=store_sid)
+    error = check_store_admission(store_code, 'clients')
+    if error:
+        emit('clients_data', {'error': error})
+        return
+    req = add_pending_request(client_sid, 'clients', store_code)
+    if req is None:
+        return
+    print(f'API: pending_requests after get_clients: {pending_requests[client_sid]}')
+    socketio.emit('get_clients', with_request_id(data, req), room=store_sid)
 
 @socketio.on('clients_data')
 def handle_clients_data(data):
     update_activity_for_session()
-    print(f'API: clients_data received, pending_requests={pending_requests}')
-    for client_sid, reqs in list(pending_requests.items()):
-        if not isinstance(reqs, list):
-            print(f"WARNING: pending_requests[{client_sid}] is not a list, skipping: {reqs}")
-            continue
-        for i, req in enumerate(reqs):
-            if req['type'] == 'clients':
-                print(f'API: relaying clients_data to client_sid={client_sid}')
-                socketio.emit('clients_data', data, room=client_sid)
-                del pending_requests[client_sid][i]
-                if not pending_requests[client_sid]:
-                    del pending_requests[client_sid]
-                return
+    client_sid, _ = pop_pending_request('clients', request_id=echoed_request_id(data))
+    if client_sid:
+        print(f'API: relaying clients_data to client_sid={client_sid}')
+        socketio.emit('clients_data', data, room=client_sid)
 
 @socketio.on('get_sales')
 def handle_get_sales(data):
@@ -388,30 +906,23 @@ def handle_get_sales(data):
     if not store_sid:
         emit('sales_data', {'error': 'Store backend not connected'})
         return
-    if client_sid not in pending_requests:
-        pending_requests[client_sid] = []
-    if isinstance(pending_requests[client_sid], dict):
-        pending_requests[client_sid] = [pending_requests[client_sid]]
-    pending_requests[client_sid].append({'type': 'sales', 'store_code': store_code})
-    print(f'API: pending_requests after get_sales: {pending_requests}')
-    socketio.emit('get_sales', data, room=store_sid)
+    error = check_store_admission(store_code, 'sales')
+    if error:
+        emit('sales_data', {'error': error})
+        return
+    req = add_pending_request(client_sid, 'sales', store_code)
+    if req is None:
+        return
+    print(f'API: pending_requests after get_sales: {pending_requests[client_sid]}')
+    socketio.emit('get_sales', with_request_id(data, req), room=store_sid)
 
 @socketio.on('sales_data')
 def handle_sales_data(data):
     update_activity_for_session()
-    print(f'API: sales_data received, pending_requests={pending_requests}')
-    for client_sid, reqs in list(pending_requests.items()):
-        if not isinstance(reqs, list):
-            print(f"WARNING: pending_requests[{client_sid}] is not a list, skipping: {reqs}")
-            continue
-        for i, req in enumerate(reqs):
-            if req['type'] == 'sales':
-                print(f'API: relaying sales_data to client_sid={client_sid}')
-                socketio.emit('sales_data', data, room=client_sid)
-                del pending_requests[client_sid][i]
-                if not pending_requests[client_sid]:
-                    del pending_requests[client_sid]
-                return
+    client_sid, _ = pop_pending_request('sales', request_id=echoed_request_id(data))
+    if client_sid:
+        print(f'API: relaying sales_data to client_sid={client_sid}')
+        socketio.emit('sales_data', data, room=client_sid)
 
 @socketio.on('get_sale_details')
 def handle_get_sale_details(data):
@@ -425,30 +936,23 @@ def handle_get_sale_details(data):
     if not store_sid:
         emit('sale_details_data', {'error': 'Store backend not connected'})
         return
-    if client_sid not in pending_requests:
-        pending_requests[client_sid] = []
-    if isinstance(pending_requests[client_sid], dict):
-        pending_requests[client_sid] = [pending_requests[client_sid]]
-    pending_requests[client_sid].append({'type': 'sale_details', 'store_code': store_code, 'sale_id': sale_id})
-    print(f'API: pending_requests after get_sale_details: {pending_requests}')
-    socketio.emit('get_sale_details', {'sale_id': sale_id}, room=store_sid)
+    error = check_store_admission(store_code, 'sale_details')
+    if error:
+        emit('sale_details_data', {'error': error})
+        return
+    req = add_pending_request(client_sid, 'sale_details', store_code)
+    if req is None:
+        return
+    print(f'API: pending_requests after get_sale_details: {pending_requests[client_sid]}')
+    socketio.emit('get_sale_details', with_request_id({'sale_id': sale_id}, req), room=store_sid)
 
 @socketio.on('sale_details_data')
 def handle_sale_details_data(data):
     update_activity_for_session()
-    print(f'API: sale_details_data received, pending_requests={pending_requests}')
-    for client_sid, reqs in list(pending_requests.items()):
-        if not isinstance(reqs, list):
-            print(f"WARNING: pending_requests[{client_sid}] is not a list, skipping: {reqs}")
-            continue
-        for i, req in enumerate(reqs):
-            if req['type'] == 'sale_details':
-                print(f'API: relaying sale_details_data to client_sid={client_sid}')
-                socketio.emit('sale_details_data', data, room=client_sid)
-                del pending_requests[client_sid][i]
-                if not pending_requests[client_sid]:
-                    del pending_requests[client_sid]
-                return
+    client_sid, _ = pop_pending_request('sale_details', request_id=echoed_request_id(data))
+    if client_sid:
+        print(f'API: relaying sale_details_data to client_sid={client_sid}')
+        socketio.emit('sale_details_data', data, room=client_sid)
 
 @socketio.on('get_vendeurs')
 def handle_get_vendeurs(data):
@@ -462,28 +966,24 @@ def handle_get_vendeurs(data):
     if not store_sid:
         emit('vendeurs_data', {'error': 'Store backend not connected'})
         return
-    if client_sid not in pending_requests:
-        pending_requests[client_sid] = []
-    if isinstance(pending_requests[client_sid], dict):
-        pending_requests[client_sid] = [pending_requests[client_sid]]
-    pending_requests[client_sid].append({'type': 'vendeurs', 'store_code': store_code})
-    print(f'API: pending_requests after get_vendeurs: {pending_requests}')
-    socketio.emit('get_vendeurs', data, room=store_sid)
+    error = check_store_admission(store_code, 'vendeurs')
+    if error:
+        emit('vendeurs_data', {'error': error})
+        return
+    req = add_pending_request(client_sid, 'vendeurs', store_code)
+    if req is None:
+        return
+    print(f'API: pending_requests after get_vendeurs: {pending_requests[client_sid]}')
+    socketio.emit('get_vendeurs', with_request_id(data, req), room=store_sid)
 
 @socketio.on('vendeurs_data')
 def handle_vendeurs_data(data):
     update_activity_for_session()
-    print(f'API: vendeurs_data received, pending_requests={pending_requests}')
     # Relay vendeurs data to the client who requested it
-    for client_sid, reqs in list(pending_requests.items()):
-        for i, req in enumerate(reqs):
-            if req['type'] == 'vendeurs':
-                print(f'API: relaying vendeurs_data to client_sid={client_sid}')
-                socketio.emit('vendeurs_data', data, room=client_sid)
-                del pending_requests[client_sid][i]
-                if not pending_requests[client_sid]:
-                    del pending_requests[client_sid]
-                return
+    client_sid, _ = pop_pending_request('vendeurs', request_id=echoed_request_id(data))
+    if client_sid:
+        print(f'API: relaying vendeurs_data to client_sid={client_sid}')
+        socketio.emit('vendeurs_data', data, room=client_sid)
 
 @socketio.on('get_clients_list')
 def handle_get_clients_list(data):
@@ -497,28 +997,73 @@ def handle_get_clients_list(data):
     if not store_sid:
         emit('clients_list_data', {'error': 'Store backend not connected'})
         return
-    if client_sid not in pending_requests:
-        pending_requests[client_sid] = []
-    if isinstance(pending_requests[client_sid], dict):
-        pending_requests[client_sid] = [pending_requests[client_sid]]
-    pending_requests[client_sid].append({'type': 'clients_list', 'store_code': store_code})
-    print(f'API: pending_requests after get_clients_list: {pending_requests}')
-    socketio.emit('get_clients_list', data, room=store_sid)
+    error = check_store_admission(store_code, 'clients_list')
+    if error:
+        emit('clients_list_data', {'error': error})
+        return
+    req = add_pending_request(client_sid, 'clients_list', store_code)
+    if req is None:
+        return
+    print(f'API: pending_requests after get_clients_list: {pending_requests[client_sid]}')
+    socketio.emit('get_clients_list', with_request_id(data, req), room=store_sid)
 
 @socketio.on('clients_list_data')
 def handle_clients_list_data(data):
     update_activity_for_session()
-    print(f'API: clients_list_data received, pending_requests={pending_requests}')
     # Relay clients list data to the client who requested it
-    for client_sid, reqs in list(pending_requests.items()):
-        for i, req in enumerate(reqs):
-            if req['type'] == 'clients_list':
-                print(f'API: relaying clients_list_data to client_sid={client_sid}')
-                socketio.emit('clients_list_data', data, room=client_sid)
-                del pending_requests[client_sid][i]
-                if not pending_requests[client_sid]:
-                    del pending_requests[client_sid]
-                return
+    client_sid, _ = pop_pending_request('clients_list', request_id=echoed_request_id(data))
+    if client_sid:
+        print(f'API: relaying clients_list_data to client_sid={client_sid}')
+        socketio.emit('clients_list_data', data, room=client_sid)
+
+# Processed usernames_list per store, served without asking the backend. Entries older than
+# USERNAMES_REFRESH_AFTER are still served but refreshed in the background; a users_changed event
+# from the backend or a re-registration drops the entry and refetches it. Concurrent misses share one request;
+# clients still waiting after STORE_REQUEST_TIMEOUT get an error.
+USERNAMES_CACHE_TTL = float(os.environ.get('USERNAMES_CACHE_TTL', 3600))  # seconds before an entry is unusable
+USERNAMES_REFRESH_AFTER = float(os.environ.get('USERNAMES_REFRESH_AFTER', 300))
+USERNAMES_REFRESH_SID = 'relay:usernames'  # client_sid of background refreshes
+usernames_cache = {}  # store_code: (fetched_at, usernames_list payload)
+usernames_fetching = {}  # store_code: (requested_at, set of client_sids waiting)
+
+def request_usernames(store_code, client_sid=None, force=False):
+    """Ask the backend for its users unless a request is already in flight (force: ask again anyway);
+    client_sid, and every client already waiting, gets the answer"""
+    requested_at, waiters = usernames_fetching.get(store_code, (0, set()))
+    if client_sid:
+        waiters.add(client_sid)
+    if requested_at and not force:
+        return
+    requested_at = time.time()
+    usernames_fetching[store_code] = (requested_at, waiters)
+    gevent.spawn_later(STORE_REQUEST_TIMEOUT, expire_usernames_request, store_code, requested_at)
+    socketio.emit('get_usernames_request', {'client_sid': client_sid or USERNAMES_REFRESH_SID},
+                  room=store_sessions[store_code])
+    print(f"[API] Relayed get_usernames_request to backend for store {store_code}")
+
+def expire_usernames_request(store_code, requested_at):
+    fetching = usernames_fetching.get(store_code)
+    if not fetching or fetching[0] != requested_at:
+        # Answered, or superseded by a newer request
+        return
+    del usernames_fetching[store_code]
+    for sid in fetching[1]:
+        socketio.emit('usernames_list', {'usernames': [], 'users': [], 'error': 'Store backend timeout'}, room=sid)
+
+def build_usernames_response(users):
+    # Derive usernames on the fly for UI convenience
+    usernames = []
+    if isinstance(users, list):
+        for u in users:
+            try:
+                name = u.get('username') or u.get('np') or u.get('nom') or ''
+                if name:
+                    usernames.append(name)
+            except Exception:
+                pass
+    else:
+        users = []
+    return {'usernames': usernames, 'users': users, 'error': None}
 
 @socketio.on('get_usernames')
 def handle_get_usernames(data):
@@ -528,19 +1073,18 @@ def handle_get_usernames(data):
         emit('usernames_list', {'usernames': [], 'error': 'Missing store code'})
         return
     # Validate that the store backend is connected (store previously registered with auth_code)
-    if store_code not in store_sessions:
-        emit('usernames_list', {'usernames': [], 'error': 'Store backend not connected'})
-        return
-    # Relay to Windows backend - let it handle the response directly
     store_sid = store_sessions.get(store_code)
     if not store_sid:
         emit('usernames_list', {'usernames': [], 'error': 'Store backend not connected'})
         return
-    
-    # Send request to backend - backend will respond directly to client
-    socketio.emit('get_usernames_request', {'client_sid': client_sid}, room=store_sid)
-    print(f"[API] Relayed get_usernames_request to backend for store {store_code}, client {client_sid}")
-    print(f"[API] Backend will respond directly to client {client_sid}")
+    cached = usernames_cache.get(store_code)
+    age = time.time() - cached[0] if cached else None
+    if cached and age < USERNAMES_CACHE_TTL:
+        emit('usernames_list', cached[1])
+        if age > USERNAMES_REFRESH_AFTER:
+            request_usernames(store_code)
+        return
+    request_usernames(store_code, client_sid)
 
 @socketio.on('usernames_list_response')
 def handle_usernames_list_response(data):
@@ -548,32 +1092,37 @@ def handle_usernames_list_response(data):
     client_sid = data.get('client_sid')
     users = data.get('users', [])
     error = data.get('error')
-    
-    if not client_sid:
+    store_code = get_store_code_for_sid(request.sid)
+    requested_at, waiters = usernames_fetching.pop(store_code, (0, set()))
+    if client_sid and client_sid != USERNAMES_REFRESH_SID:
+        waiters.add(client_sid)
+    if not waiters and client_sid != USERNAMES_REFRESH_SID:
         print(f"[API] usernames_list_response missing client_sid, data: {data}")
         return
-    
+
     if error:
-        print(f"[API] Backend error for client {client_sid}: {error}")
-        socketio.emit('usernames_list', {'usernames': [], 'users': [], 'error': error}, room=client_sid)
+        print(f"[API] Backend error for store {store_code}: {error}")
+        for sid in waiters:
+            socketio.emit('usernames_list', {'usernames': [], 'users': [], 'error': error}, room=sid)
         return
-    
-    # Derive usernames on the fly for UI convenience
-    usernames = []
-    if isinstance(users, list):
-        for u in users:
-            try:
-                name = u.get('username') or u.get('np') or u.get('nom') or ''
-                if name:
-                    usernames.append(name)
-            except Exception:
-                pass
-    else:
-        users = []
-    
-    response_data = {'usernames': usernames, 'users': users, 'error': None}
-    socketio.emit('usernames_list', response_data, room=client_sid)
-    print(f"[API] Relayed usernames_list to client {client_sid} (users: {len(users)}, usernames: {len(usernames)})")
+
+    response_data = build_usernames_response(users)
+    if store_code:
+        usernames_cache[store_code] = (time.time(), response_data)
+    for sid in waiters:
+        socketio.emit('usernames_list', response_data, room=sid)
+    print(f"[API] Relayed usernames_list for store {store_code} to {len(waiters)} clients "
+          f"(users: {len(response_data['users'])}, usernames: {len(response_data['usernames'])})")
+
+@socketio.on('users_changed')
+def handle_users_changed(data):
+    """Store backend reports added/renamed/removed users: refetch its usernames list"""
+    update_activity_for_session()
+    store_code = get_store_code_for_sid(request.sid)
+    if not store_code:
+        return
+    usernames_cache.pop(store_code, None)
+    request_usernames(store_code, force=True)
 
 # Backend now sends usernames_list_response which we relay as usernames_list
 
@@ -586,16 +1135,20 @@ def handle_get_treasury(data):
         emit('treasury_data', {'success': False, 'error': 'Store not connected', 'data': {}, 'client_sid': client_sid})
         return
     backend_sid = store_sessions[store_code]
+    error = check_store_admission(store_code, 'get_treasury')
+    if error:
+        emit('treasury_data', {'success': False, 'error': error, 'data': {}, 'client_sid': client_sid})
+        return
     # Track pending request
-    req = {'type': 'get_treasury', 'client_sid': client_sid}
-    if client_sid not in pending_requests or not isinstance(pending_requests[client_sid], list):
-        pending_requests[client_sid] = []
-    pending_requests[client_sid].append(req)
+    req = add_pending_request(client_sid, 'get_treasury', store_code)
+    if req is None:
+        return
     # Relay to backend
     socketio.emit('get_treasury', {
         'date_from': data.get('date_from'),
         'date_to': data.get('date_to'),
-        'client_sid': client_sid
+        'client_sid': client_sid,
+        'relay_request_id': req.request_id
     }, room=backend_sid)
 
 @socketio.on('treasury_data')
@@ -605,16 +1158,7 @@ def handle_treasury_data(data):
     if not client_sid:
         return
     # Find and remove the matching pending request
-    reqs = pending_requests.get(client_sid, [])
-    if isinstance(reqs, list):
-        for i, req in enumerate(reqs):
-            if req.get('type') == 'get_treasury':
-                del reqs[i]
-                break
-        if not reqs:
-            pending_requests.pop(client_sid, None)
-        else:
-            pending_requests[client_sid] = reqs
+    pop_pending_request('get_treasury', client_sid=client_sid, request_id=echoed_request_id(data))
     # Relay result to client
     socketio.emit('treasury_data', data, room=client_sid)
 
@@ -630,22 +1174,21 @@ def handle_get_fournisseurs(data):
     if not store_sid:
         emit('fournisseurs_data', {'error': 'Store backend not connected'})
         return
-    if client_sid not in pending_requests:
-        pending_requests[client_sid] = []
-    pending_requests[client_sid].append({'type': 'fournisseurs', 'store_code': store_code})
-    socketio.emit('get_fournisseurs', data, room=store_sid)
+    error = check_store_admission(store_code, 'fournisseurs')
+    if error:
+        emit('fournisseurs_data', {'error': error})
+        return
+    req = add_pending_request(client_sid, 'fournisseurs', store_code)
+    if req is None:
+        return
+    socketio.emit('get_fournisseurs', with_request_id(data, req), room=store_sid)
 
 @socketio.on('fournisseurs_data')
 def handle_fournisseurs_data(data):
     update_activity_for_session()
-    for client_sid, reqs in list(pending_requests.items()):
-        for i, req in enumerate(reqs):
-            if req['type'] == 'fournisseurs':
-                socketio.emit('fournisseurs_data', data, room=client_sid)
-                del pending_requests[client_sid][i]
-                if not pending_requests[client_sid]:
-                    del pending_requests[client_sid]
-                return
+    client_sid, _ = pop_pending_request('fournisseurs', request_id=echoed_request_id(data))
+    if client_sid:
+        socketio.emit('fournisseurs_data', data, room=client_sid)
 
 # --- FACTURES ACHAT RELAY ---
 @socketio.on('get_factures_achat')
@@ -659,22 +1202,21 @@ def handle_get_factures_achat(data):
     if not store_sid:
         emit('factures_achat_data', {'error': 'Store backend not connected'})
         return
-    if client_sid not in pending_requests:
-        pending_requests[client_sid] = []
-    pending_requests[client_sid].append({'type': 'factures_achat', 'store_code': store_code})
-    socketio.emit('get_factures_achat', data, room=store_sid)
+    error = check_store_admission(store_code, 'factures_achat')
+    if error:
+        emit('factures_achat_data', {'error': error})
+        return
+    req = add_pending_request(client_sid, 'factures_achat', store_code)
+    if req is None:
+        return
+    socketio.emit('get_factures_achat', with_request_id(data, req), room=store_sid)
 
 @socketio.on('factures_achat_data')
 def handle_factures_achat_data(data):
     update_activity_for_session()
-    for client_sid, reqs in list(pending_requests.items()):
-        for i, req in enumerate(reqs):
-            if req['type'] == 'factures_achat':
-                socketio.emit('factures_achat_data', data, room=client_sid)
-                del pending_requests[client_sid][i]
-                if not pending_requests[client_sid]:
-                    del pending_requests[client_sid]
-                return
+    client_sid, _ = pop_pending_request('factures_achat', request_id=echoed_request_id(data))
+    if client_sid:
+        socketio.emit('factures_achat_data', data, room=client_sid)
 
 # --- FACTURE ACHAT DETAILS RELAY ---
 @socketio.on('get_facture_achat_details')
@@ -688,22 +1230,21 @@ def handle_get_facture_achat_details(data):
     if not store_sid:
         emit('facture_achat_details_data', {'error': 'Store backend not connected'})
         return
-    if client_sid not in pending_requests:
-        pending_requests[client_sid] = []
-    pending_requests[client_sid].append({'type': 'facture_achat_details', 'store_code': store_code})
-    socketio.emit('get_facture_achat_details', data, room=store_sid)
+    error = check_store_admission(store_code, 'facture_achat_details')
+    if error:
+        emit('facture_achat_details_data', {'error': error})
+        return
+    req = add_pending_request(client_sid, 'facture_achat_details', store_code)
+    if req is None:
+        return
+    socketio.emit('get_facture_achat_details', with_request_id(data, req), room=store_sid)
 
 @socketio.on('facture_achat_details_data')
 def handle_facture_achat_details_data(data):
     update_activity_for_session()
-    for client_sid, reqs in list(pending_requests.items()):
-        for i, req in enumerate(reqs):
-            if req['type'] == 'facture_achat_details':
-                socketio.emit('facture_achat_details_data', data, room=client_sid)
-                del pending_requests[client_sid][i]
-                if not pending_requests[client_sid]:
-                    del pending_requests[client_sid]
-                return
+    client_sid, _ = pop_pending_request('facture_achat_details', request_id=echoed_request_id(data))
+    if client_sid:
+        socketio.emit('facture_achat_details_data', data, room=client_sid)
 
 @socketio.on('get_factures_vente')
 def handle_get_factures_vente(data):
@@ -719,31 +1260,25 @@ def handle_get_factures_vente(data):
         print("API Backend: Store backend not connected")
         emit('factures_vente_data', {'error': 'Store backend not connected'})
         return
-    if client_sid not in pending_requests:
-        pending_requests[client_sid] = []
-    if isinstance(pending_requests[client_sid], dict):
-        pending_requests[client_sid] = [pending_requests[client_sid]]
-    pending_requests[client_sid].append({'type': 'factures_vente', 'store_code': store_code})
-    print(f'API Backend: pending_requests after get_factures_vente: {pending_requests}')
+    error = check_store_admission(store_code, 'factures_vente')
+    if error:
+        emit('factures_vente_data', {'error': error})
+        return
+    req = add_pending_request(client_sid, 'factures_vente', store_code)
+    if req is None:
+        return
+    print(f'API Backend: pending_requests after get_factures_vente: {pending_requests[client_sid]}')
     print(f"API Backend: Emitting to store_sid: {store_sid}")
-    socketio.emit('get_factures_vente', data, room=store_sid)
+    socketio.emit('get_factures_vente', with_request_id(data, req), room=store_sid)
 
 @socketio.on('factures_vente_data')
 def handle_factures_vente_data(data):
     update_activity_for_session()
     print(f'API Backend: factures_vente_data received: {data}')
-    for client_sid, reqs in list(pending_requests.items()):
-        if not isinstance(reqs, list):
-            print(f"WARNING: pending_requests[{client_sid}] is not a list, skipping: {reqs}")
-            continue
-        for i, req in enumerate(reqs):
-            if req['type'] == 'factures_vente':
-                print(f'API Backend: relaying factures_vente_data to client_sid={client_sid}')
-                socketio.emit('factures_vente_data', data, room=client_sid)
-                del pending_requests[client_sid][i]
-                if not pending_requests[client_sid]:
-                    del pending_requests[client_sid]
-                return
+    client_sid, _ = pop_pending_request('factures_vente', request_id=echoed_request_id(data))
+    if client_sid:
+        print(f'API Backend: relaying factures_vente_data to client_sid={client_sid}')
+        socketio.emit('factures_vente_data', data, room=client_sid)
 
 @socketio.on('get_facture_vente_details')
 def handle_get_facture_vente_details(data):
@@ -757,48 +1292,138 @@ def handle_get_facture_vente_details(data):
     if not store_sid:
         emit('facture_vente_details_data', {'error': 'Store backend not connected'})
         return
-    if client_sid not in pending_requests:
-        pending_requests[client_sid] = []
-    if isinstance(pending_requests[client_sid], dict):
-        pending_requests[client_sid] = [pending_requests[client_sid]]
-    pending_requests[client_sid].append({'type': 'facture_vente_details', 'store_code': store_code, 'facture_id': facture_id})
-    print(f'API: pending_requests after get_facture_vente_details: {pending_requests}')
-    socketio.emit('get_facture_vente_details', {'facture_id': facture_id}, room=store_sid)
+    error = check_store_admission(store_code, 'facture_vente_details')
+    if error:
+        emit('facture_vente_details_data', {'error': error})
+        return
+    req = add_pending_request(client_sid, 'facture_vente_details', store_code)
+    if req is None:
+        return
+    print(f'API: pending_requests after get_facture_vente_details: {pending_requests[client_sid]}')
+    socketio.emit('get_facture_vente_details', with_request_id({'facture_id': facture_id}, req), room=store_sid)
 
 @socketio.on('facture_vente_details_data')
 def handle_facture_vente_details_data(data):
     update_activity_for_session()
-    print(f'API: facture_vente_details_data received, pending_requests={pending_requests}')
-    for client_sid, reqs in list(pending_requests.items()):
-        if not isinstance(reqs, list):
-            print(f"WARNING: pending_requests[{client_sid}] is not a list, skipping: {reqs}")
+    client_sid, _ = pop_pending_request('facture_vente_details', request_id=echoed_request_id(data))
+    if client_sid:
+        print(f'API: relaying facture_vente_details_data to client_sid={client_sid}')
+        socketio.emit('facture_vente_details_data', data, room=client_sid)
+
+# --- STOC ENTRIES TYPEAHEAD ---
+# Clients search on every keystroke. Each search carries a sequence number (assigned here if the
+# client sends none); a newer term supersedes older ones, which are dropped before being forwarded
+# (STOC_SEARCH_DEBOUNCE) or when their answer arrives. Answers are cached per store by term. Dropping and
+# caching need the backend to echo seq or term; answers echoing neither are relayed unchanged.
+# With STOC_ENTRIES_LOCAL_REFINE=1 a refinement of a cached term is also answered locally by filtering
+# its entries. That is only correct if the backend matches the term as a case-insensitive substring of
+# the entries' string fields and returns at most STOC_ENTRIES_RESULT_LIMIT rows, so it is off by default.
+STOC_SEARCH_DEBOUNCE = float(os.environ.get('STOC_SEARCH_DEBOUNCE', 0.15))  # seconds
+STOC_ENTRIES_CACHE_TTL = float(os.environ.get('STOC_ENTRIES_CACHE_TTL', 30))  # seconds
+STOC_ENTRIES_CACHE_SIZE = int(os.environ.get('STOC_ENTRIES_CACHE_SIZE', 200))  # terms per store
+STOC_ENTRIES_LOCAL_REFINE = os.environ.get('STOC_ENTRIES_LOCAL_REFINE', '0') == '1'
+# Backend result cap; a result of this length may be truncated and is not refined locally
+STOC_ENTRIES_RESULT_LIMIT = int(os.environ.get('STOC_ENTRIES_RESULT_LIMIT', 100))
+stoc_search_seq = {}  # client_sid: latest seq
+stoc_search_timers = {}  # client_sid: greenlet that forwards the latest term once the debounce window closes
+stoc_search_inflight = {}  # client_sid: deque([(seq, store_code, term, sent_at)]) forwarded, awaiting the backend
+stoc_entries_cache = {}  # store_code: OrderedDict(normalized term: (fetched_at, entries))
+
+def normalize_term(term):
+    return (term or '').strip().lower()
+
+def entry_matches(entry, needle):
+    if isinstance(entry, dict):
+        return any(isinstance(v, str) and needle in v.lower() for v in entry.values())
+    return isinstance(entry, str) and needle in entry.lower()
+
+def lookup_stoc_entries(store_code, term):
+    """Answer from the store's cache: the term itself, or (local refine) the longest cached complete prefix filtered down"""
+    cache = stoc_entries_cache.get(store_code)
+    if not cache:
+        return None
+    needle = normalize_term(term)
+    now = time.time()
+    shortest = 0 if STOC_ENTRIES_LOCAL_REFINE else len(needle)
+    for length in range(len(needle), shortest - 1, -1):
+        prefix = needle[:length]
+        hit = cache.get(prefix)
+        if hit is None or now - hit[0] > STOC_ENTRIES_CACHE_TTL:
             continue
-        for i, req in enumerate(reqs):
-            if req['type'] == 'facture_vente_details':
-                print(f'API: relaying facture_vente_details_data to client_sid={client_sid}')
-                socketio.emit('facture_vente_details_data', data, room=client_sid)
-                del pending_requests[client_sid][i]
-                if not pending_requests[client_sid]:
-                    del pending_requests[client_sid]
-                return
+        fetched_at, entries = hit
+        if length == len(needle):
+            cache.move_to_end(prefix)
+            return entries
+        if len(entries) >= STOC_ENTRIES_RESULT_LIMIT:
+            # A truncated prefix result can miss entries of the refinement; shorter prefixes are even larger
+            return None
+        cache.move_to_end(prefix)
+        return [entry for entry in entries if entry_matches(entry, needle)]
+    return None
+
+def cache_stoc_entries(store_code, term, entries):
+    cache = stoc_entries_cache.setdefault(store_code, collections.OrderedDict())
+    cache[normalize_term(term)] = (time.time(), entries)
+    cache.move_to_end(normalize_term(term))
+    while len(cache) > STOC_ENTRIES_CACHE_SIZE:
+        cache.popitem(last=False)
+
+def forward_stoc_search(client_sid, store_code, term, seq):
+    stoc_search_timers.pop(client_sid, None)
+    if stoc_search_seq.get(client_sid) != seq:
+        return
+    store_sid = store_sessions.get(store_code)
+    if not store_sid:
+        socketio.emit('stoc_entries_data', {'error': 'Store backend not connected', 'entries': [], 'client_sid': client_sid,
+                                            'term': term, 'seq': seq}, room=client_sid)
+        return
+    inflight = stoc_search_inflight.setdefault(client_sid, collections.deque())
+    # Answers that never came must not pile up
+    while inflight and time.time() - inflight[0][3] > STORE_REQUEST_TIMEOUT:
+        inflight.popleft()
+    inflight.append((seq, store_code, term, time.time()))
+    # Forward request to backend with client_sid for routing
+    socketio.emit('get_stoc_entries', {'term': term, 'client_sid': client_sid, 'seq': seq}, room=store_sid)
+
+def clear_stoc_search(client_sid):
+    timer = stoc_search_timers.pop(client_sid, None)
+    if timer is not None:
+        timer.kill(block=False)
+    stoc_search_seq.pop(client_sid, None)
+    stoc_search_inflight.pop(client_sid, None)
 
 @socketio.on('get_stoc_entries')
 def handle_get_stoc_entries(data):
+    # data: {'term': ..., 'seq': optional, increasing per client}
     client_sid = request.sid
     store_code = client_sessions.get(client_sid)
     if not store_code:
         emit('stoc_entries_data', {'error': 'Not registered for a store', 'entries': [], 'client_sid': client_sid})
         return
-    store_sid = store_sessions.get(store_code)
-    if not store_sid:
-        emit('stoc_entries_data', {'error': 'Store backend not connected', 'entries': [], 'client_sid': client_sid})
-        return
+    data = data if isinstance(data, dict) else {}
+    term = data.get('term')
+    latest = stoc_search_seq.get(client_sid, 0)
     try:
-        term = (data or {}).get('term') if isinstance(data, dict) else None
-    except Exception:
-        term = None
-    # Forward request to backend with client_sid for routing
-    socketio.emit('get_stoc_entries', {'term': term, 'client_sid': client_sid}, room=store_sid)
+        seq = int(data['seq']) if data.get('seq') is not None else latest + 1
+    except (TypeError, ValueError):
+        seq = latest + 1
+    if seq <= latest:
+        # Arrived after a newer search from the same client
+        return
+    stoc_search_seq[client_sid] = seq
+    timer = stoc_search_timers.pop(client_sid, None)
+    if timer is not None:
+        timer.kill(block=False)
+    entries = lookup_stoc_entries(store_code, term)
+    if entries is not None:
+        emit('stoc_entries_data', {'entries': entries, 'term': term, 'seq': seq, 'client_sid': client_sid, 'cached': True})
+        return
+    if not store_sessions.get(store_code):
+        emit('stoc_entries_data', {'error': 'Store backend not connected', 'entries': [], 'client_sid': client_sid,
+                                   'term': term, 'seq': seq})
+        return
+    stoc_search_timers[client_sid] = gevent.spawn_later(STOC_SEARCH_DEBOUNCE, forward_stoc_search,
+                                                        client_sid, store_code, term, seq)
 
 @socketio.on('stoc_entries_data')
 def handle_stoc_entries_data(data):
@@ -806,6 +1431,36 @@ def handle_stoc_entries_data(data):
     client_sid = (data or {}).get('client_sid')
     payload = data or {}
     if client_sid:
+        # Only an answer that echoes seq or term can be tied to its search; one without either is relayed
+        # as is, since with a lost answer any order-based guess would shift every later match
+        inflight = stoc_search_inflight.get(client_sid)
+        try:
+            reply_seq = int(payload['seq']) if payload.get('seq') is not None else None
+        except (TypeError, ValueError):
+            reply_seq = None
+        reply_term = payload.get('term') if isinstance(payload.get('term'), str) else None
+        matched = None
+        if inflight and reply_seq is not None:
+            matched = next((candidate for candidate in inflight if candidate[0] == reply_seq), None)
+        elif inflight and reply_term is not None:
+            # Searches for the same term share one answer; the newest decides whether it is still wanted
+            same_term = [candidate for candidate in inflight if normalize_term(candidate[2]) == normalize_term(reply_term)]
+            for candidate in same_term[:-1]:
+                inflight.remove(candidate)
+            matched = same_term[-1] if same_term else None
+        if matched:
+            inflight.remove(matched)
+            if not inflight:
+                stoc_search_inflight.pop(client_sid, None)
+            seq, store_code, term, _ = matched
+            term = reply_term if reply_term is not None else term
+            if not payload.get('error') and isinstance(payload.get('entries'), list):
+                cache_stoc_entries(store_code, term, payload['entries'])
+            payload = dict(payload, seq=seq, term=term)
+            reply_seq = seq
+        if reply_seq is not None and reply_seq < stoc_search_seq.get(client_sid, 0):
+            # Superseded by a newer term (or answered out of order); the client no longer wants this answer
+            return
         socketio.emit('stoc_entries_data', payload, room=client_sid)
     else:
         # Fallback: broadcast to all clients in the store room
@@ -818,6 +1473,230 @@ def handle_stoc_entries_data(data):
         except Exception:
             pass
 
+# --- SAVE VENTE JOURNAL ---
+# save_vente carrying an 'idempotency_key' is appended to a local journal (fsynced in groups),
+# acked with save_vente_queued, and replayed in order to the store backend once it is connected.
+# Keys are scoped to the client's store. Store backends must echo idempotency_key in save_vente_response
+# and ignore keys they have already applied: entries unanswered when a connection drops are sent again.
+# Journal lines: {'op': 'append', 'key', 'store_code', 'data', 'ts'} and {'op': 'done', 'key', 'store_code', 'result', 'ts'}
+SAVE_VENTE_JOURNAL_PATH = os.environ.get('SAVE_VENTE_JOURNAL_PATH', 'save_vente_journal.log')
+SAVE_VENTE_GROUP_COMMIT_WINDOW = float(os.environ.get('SAVE_VENTE_GROUP_COMMIT_WINDOW', 0.005))  # seconds
+SAVE_VENTE_DONE_RETENTION = int(os.environ.get('SAVE_VENTE_DONE_RETENTION', 24 * 3600))  # keep keys for dedup
+vente_journal = {}  # (store_code, idempotency_key): {'key', 'store_code', 'data', 'ts', 'status', 'client_sid', 'result', 'commit'}
+vente_pending = {}  # store_code: [idempotency_key, ...] not yet answered by the store, in journal order
+vente_inflight = {}  # store_code: [idempotency_key, ...] sent to the current store connection, awaiting response
+vente_journal_file = None
+vente_journal_lock = gevent.lock.BoundedSemaphore()
+vente_commit_buffer = []  # [(line, AsyncResult)] waiting for the next group commit
+vente_commit_scheduled = False
+vente_journal_stats = {'commits': 0, 'records': 0, 'last_commit_ms': 0.0, 'max_commit_ms': 0.0, 'total_commit_ms': 0.0}
+
+def journal_append(record):
+    """Queue a journal record for the next group commit; the returned AsyncResult is set once it is fsynced"""
+    global vente_commit_scheduled
+    result = gevent.event.AsyncResult()
+    line = (json.dumps(record, separators=(',', ':')) + '\n').encode()
+    vente_commit_buffer.append((line, result))
+    if not vente_commit_scheduled:
+        vente_commit_scheduled = True
+        gevent.spawn_later(SAVE_VENTE_GROUP_COMMIT_WINDOW, flush_vente_journal)
+    return result
+
+def flush_vente_journal():
+    """Write and fsync every buffered record in one go, then wake up their waiters"""
+    global vente_journal_file, vente_commit_scheduled
+    with vente_journal_lock:
+        while vente_commit_buffer:
+            batch = vente_commit_buffer[:]
+            del vente_commit_buffer[:]
+            started = time.time()
+            try:
+                if vente_journal_file is None:
+                    vente_journal_file = open(SAVE_VENTE_JOURNAL_PATH, 'ab')
+                vente_journal_file.write(b''.join(line for line, _ in batch))
+                vente_journal_file.flush()
+                # fsync in the threadpool so the hub keeps serving while the disk syncs
+                gevent.get_hub().threadpool.apply(os.fsync, (vente_journal_file.fileno(),))
+            except Exception as e:
+                print(f"Error writing save_vente journal: {e}")
+                for _, result in batch:
+                    result.set_exception(e)
+                continue
+            elapsed_ms = (time.time() - started) * 1000
+            vente_journal_stats['commits'] += 1
+            vente_journal_stats['records'] += len(batch)
+            vente_journal_stats['last_commit_ms'] = elapsed_ms
+            vente_journal_stats['total_commit_ms'] += elapsed_ms
+            vente_journal_stats['max_commit_ms'] = max(vente_journal_stats['max_commit_ms'], elapsed_ms)
+            for _, result in batch:
+                result.set(None)
+        vente_commit_scheduled = False
+
+def load_vente_journal():
+    """Rebuild journal state from disk at startup and compact away expired entries"""
+    if not os.path.exists(SAVE_VENTE_JOURNAL_PATH):
+        return
+    with open(SAVE_VENTE_JOURNAL_PATH, 'rb') as f:
+        for raw in f:
+            try:
+                record = json.loads(raw)
+            except ValueError:
+                # Torn write at the tail of the journal
+                continue
+            key = record.get('key')
+            jkey = (record.get('store_code'), key)
+            if record.get('op') == 'append' and jkey not in vente_journal:
+                vente_journal[jkey] = {'key': key, 'store_code': record.get('store_code'), 'data': record.get('data'),
+                                      'ts': record.get('ts', 0), 'status': 'pending', 'client_sid': None, 'result': None}
+            elif record.get('op') == 'done':
+                entry = vente_journal.setdefault(jkey, {'key': key, 'store_code': record.get('store_code'), 'data': None,
+                                                       'ts': record.get('ts', 0), 'client_sid': None})
+                entry['status'] = 'done'
+                entry['result'] = record.get('result')
+                entry['ts'] = record.get('ts', 0)
+                entry['data'] = None
+    for (store_code, key), entry in vente_journal.items():
+        if entry['status'] == 'pending':
+            vente_pending.setdefault(store_code, []).append(key)
+    compact_vente_journal()
+    print(f"save_vente journal loaded: {len(vente_journal)} keys, {sum(len(k) for k in vente_pending.values())} pending")
+
+def write_journal_file(path, records):
+    with open(path, 'wb') as f:
+        for record in records:
+            f.write((json.dumps(record, separators=(',', ':')) + '\n').encode())
+        f.flush()
+        os.fsync(f.fileno())
+
+def compact_vente_journal():
+    """Rewrite the journal with pending entries and recently completed keys only"""
+    global vente_journal_file
+    cutoff = time.time() - SAVE_VENTE_DONE_RETENTION
+    with vente_journal_lock:
+        for jkey in [k for k, e in vente_journal.items() if e['status'] == 'done' and e['ts'] < cutoff]:
+            del vente_journal[jkey]
+        records = []
+        for (_, key), entry in vente_journal.items():
+            if entry['status'] == 'done':
+                records.append({'op': 'done', 'key': key, 'store_code': entry['store_code'], 'result': entry['result'], 'ts': entry['ts']})
+            else:
+                records.append({'op': 'append', 'key': key, 'store_code': entry['store_code'], 'data': entry['data'], 'ts': entry['ts']})
+        tmp_path = SAVE_VENTE_JOURNAL_PATH + '.tmp'
+        # Serialize, write and fsync in the threadpool like group commits; appends wait on the lock meanwhile
+        gevent.get_hub().threadpool.apply(write_journal_file, (tmp_path, records))
+        if vente_journal_file is not None:
+            vente_journal_file.close()
+            vente_journal_file = None
+        os.replace(tmp_path, SAVE_VENTE_JOURNAL_PATH)
+
+def replay_vente_journal(store_code):
+    """Send every journal entry of the store not yet sent on its current connection, oldest first"""
+    store_sid = store_sessions.get(store_code)
+    if not store_sid:
+        return
+    for key in vente_pending.get(store_code, []):
+        entry = vente_journal[(store_code, key)]
+        if entry['status'] != 'pending':
+            continue
+        entry['status'] = 'sent'
+        vente_inflight.setdefault(store_code, []).append(key)
+        payload = dict(entry['data'] or {})
+        payload['idempotency_key'] = key
+        socketio.emit('save_vente', payload, room=store_sid)
+
+def reset_vente_inflight(store_code):
+    """The store connection changed: anything sent but unanswered must be replayed"""
+    for key in vente_inflight.pop(store_code, []):
+        entry = vente_journal.get((store_code, key))
+        if entry and entry['status'] == 'sent':
+            entry['status'] = 'pending'
+
+def complete_vente_entry(store_code, key, result):
+    entry = vente_journal.get((store_code, key))
+    if not entry or entry['status'] == 'done':
+        return
+    entry['status'] = 'done'
+    entry['result'] = result
+    entry['ts'] = time.time()
+    entry['data'] = None
+    if key in vente_pending.get(store_code, []):
+        vente_pending[store_code].remove(key)
+        if not vente_pending[store_code]:
+            del vente_pending[store_code]
+    if key in vente_inflight.get(store_code, []):
+        vente_inflight[store_code].remove(key)
+    journal_append({'op': 'done', 'key': key, 'store_code': store_code, 'result': result, 'ts': entry['ts']})
+    if entry.get('client_sid'):
+        response = dict(result)
+        response['idempotency_key'] = key
+        socketio.emit('save_vente_response', response, room=entry['client_sid'])
+
+def vente_journal_maintenance():
+    """Periodically drop expired keys so the journal does not grow without bound"""
+    while True:
+        gevent.sleep(600)
+        try:
+            compact_vente_journal()
+        except Exception as e:
+            print(f"Error compacting save_vente journal: {e}")
+
+def handle_journaled_save_vente(client_sid, store_code, key, data):
+    entry = vente_journal.get((store_code, key))
+    if entry is None:
+        entry = {'key': key, 'store_code': store_code, 'data': data, 'ts': time.time(),
+                 'status': 'pending', 'client_sid': client_sid, 'result': None}
+        entry['commit'] = journal_append({'op': 'append', 'key': key, 'store_code': store_code, 'data': data, 'ts': entry['ts']})
+        vente_journal[(store_code, key)] = entry
+        try:
+            entry['commit'].get()
+        except Exception as e:
+            del vente_journal[(store_code, key)]
+            emit('save_vente_response', {'success': False, 'error': f'Journal write failed: {e}', 'idempotency_key': key})
+            return
+        vente_pending.setdefault(store_code, []).append(key)
+        emit('save_vente_queued', {'success': True, 'idempotency_key': key})
+        replay_vente_journal(store_code)
+        return
+    # Duplicate (client retry): never journal twice, answer from what we already know
+    entry['client_sid'] = client_sid
+    if entry['status'] == 'done':
+        response = dict(entry['result'] or {})
+        response['idempotency_key'] = key
+        response['duplicate'] = True
+        emit('save_vente_response', response)
+        return
+    if entry.get('commit') is not None:
+        try:
+            entry['commit'].get()
+        except Exception:
+            return
+    emit('save_vente_queued', {'success': True, 'idempotency_key': key, 'duplicate': True})
+
+@app.route('/admin/save_vente_journal')
+def get_save_vente_journal_stats():
+    """Admin endpoint exposing journal size, replay lag and group-commit latency"""
+    if not admin_authorized():
+        return jsonify({'error': 'Forbidden'}), 403
+    now = time.time()
+    waiting = [vente_journal[(sc, k)]['ts'] for sc, keys in vente_pending.items() for k in keys]
+    commits = vente_journal_stats['commits']
+    return jsonify({
+        'journal_bytes': os.path.getsize(SAVE_VENTE_JOURNAL_PATH) if os.path.exists(SAVE_VENTE_JOURNAL_PATH) else 0,
+        'journal_keys': len(vente_journal),
+        'pending_entries': len(waiting),
+        'pending_by_store': {sc: len(keys) for sc, keys in vente_pending.items()},
+        'inflight_entries': sum(len(keys) for keys in vente_inflight.values()),
+        'replay_lag_seconds': (now - min(waiting)) if waiting else 0.0,
+        'group_commit': {
+            'commits': commits,
+            'records': vente_journal_stats['records'],
+            'avg_records_per_commit': (vente_journal_stats['records'] / commits) if commits else 0.0,
+            'last_ms': vente_journal_stats['last_commit_ms'],
+            'avg_ms': (vente_journal_stats['total_commit_ms'] / commits) if commits else 0.0,
+            'max_ms': vente_journal_stats['max_commit_ms'],
+        },
+    })
+
 @socketio.on('save_vente')
 def handle_save_vente(data):
     client_sid = request.sid
@@ -825,54 +1704,164 @@ def handle_save_vente(data):
     if not store_code:
         emit('save_vente_response', {'success': False, 'error': 'Not registered for a store'})
         return
+    key = (data or {}).get('idempotency_key')
+    if key:
+        handle_journaled_save_vente(client_sid, store_code, str(key), data)
+        return
     store_sid = store_sessions.get(store_code)
     if not store_sid:
         emit('save_vente_response', {'success': False, 'error': 'Store backend not connected'})
         return
-    if client_sid not in pending_requests:
-        pending_requests[client_sid] = []
-    if isinstance(pending_requests[client_sid], dict):
-        pending_requests[client_sid] = [pending_requests[client_sid]]
-    pending_requests[client_sid].append({'type': 'save_vente', 'store_code': store_code})
-    socketio.emit('save_vente', data, room=store_sid)
+    error = check_store_admission(store_code, 'save_vente')
+    if error:
+        emit('save_vente_response', {'success': False, 'error': error})
+        return
+    req = add_pending_request(client_sid, 'save_vente', store_code)
+    if req is None:
+        return
+    socketio.emit('save_vente', with_request_id(data, req), room=store_sid)
 
 @socketio.on('save_vente_response')
 def handle_save_vente_response(data):
     update_activity_for_session()
-    print(f'API: save_vente_response received, pending_requests={pending_requests}')
-    for client_sid, reqs in list(pending_requests.items()):
-        if not isinstance(reqs, list):
+    data = data or {}
+    store_code = get_store_code_for_sid(request.sid)
+    # A sale changes stock levels, so cached stoc_entries of this store are stale
+    stoc_entries_cache.pop(store_code, None)
+    key = data.get('idempotency_key')
+    if key is not None and (store_code, str(key)) in vente_journal:
+        complete_vente_entry(store_code, str(key), {k: v for k, v in data.items() if k != 'idempotency_key'})
+        return
+    client_sid, _ = pop_pending_request('save_vente', request_id=echoed_request_id(data))
+    if client_sid:
+        print(f'API: relaying save_vente_response to client_sid={client_sid}')
+        socketio.emit('save_vente_response', data, room=client_sid)
+        return
+    if vente_inflight.get(store_code):
+        # Journaled sales are only matched by their echoed key, never by arrival order
+        print(f"WARNING: store {store_code} answered save_vente without idempotency_key; journaled sales stay pending")
+
+# --- BATCH RELAY ---
+# Sub-request events allowed inside a batch, with the field each one requires
+BATCH_REQUEST_TYPES = {
+    'get_product_details': 'np',
+    'get_product_by_barcode': None,
+    'get_sale_details': 'sale_id',
+    'get_facture_vente_details': 'facture_id',
+    'get_facture_achat_details': None,
+}
+MAX_BATCH_SIZE = 200
+
+@socketio.on('batch')
+def handle_batch(data):
+    # data: {'batch_id': optional, 'requests': [{'id': ..., 'event': ..., 'data': {...}}, ...]}
+    client_sid = request.sid
+    data = data or {}
+    batch_id = data.get('batch_id') or uuid.uuid4().hex
+    sub_requests = data.get('requests')
+    store_code = client_sessions.get(client_sid)
+    if not store_code:
+        emit('batch_data', {'batch_id': batch_id, 'error': 'Not registered for a store', 'results': []})
+        return
+    if not isinstance(sub_requests, list) or not sub_requests:
+        emit('batch_data', {'batch_id': batch_id, 'error': 'Missing requests', 'results': []})
+        return
+    if len(sub_requests) > MAX_BATCH_SIZE:
+        emit('batch_data', {'batch_id': batch_id, 'error': f'Too many requests (max {MAX_BATCH_SIZE})', 'results': []})
+        return
+    store_sid = store_sessions.get(store_code)
+    store_error = check_store_admission(store_code, 'batch') if store_sid else 'Store backend not connected'
+    # Validate each sub-request; invalid ones are answered per item, the rest go to the store
+    items = []  # [(item_id, event)] in request order
+    failed = {}  # item_id: error
+    forwarded = []
+    # Ids answers are matched on; missing, invalid or repeated ids get a generated one no other item uses
+    explicit_ids = {sub.get('id') for sub in sub_requests if isinstance(sub, dict) and isinstance(sub.get('id'), (str, int))}
+    used_ids = set()
+    for index, sub in enumerate(sub_requests):
+        sub = sub if isinstance(sub, dict) else {}
+        item_id = sub.get('id', index)
+        if not isinstance(item_id, (str, int)) or item_id in used_ids:
+            item_id = index
+            while item_id in explicit_ids or item_id in used_ids:
+                item_id += len(sub_requests)
+        used_ids.add(item_id)
+        event = sub.get('event')
+        sub_data = sub.get('data') or {}
+        items.append((item_id, event))
+        if event not in BATCH_REQUEST_TYPES:
+            failed[item_id] = f'Unsupported event: {event}'
             continue
-        for i, req in enumerate(reqs):
-            if req['type'] == 'save_vente':
-                print(f'API: relaying save_vente_response to client_sid={client_sid}')
-                socketio.emit('save_vente_response', data, room=client_sid)
-                del pending_requests[client_sid][i]
-                if not pending_requests[client_sid]:
-                    del pending_requests[client_sid]
-                return
+        required = BATCH_REQUEST_TYPES[event]
+        if not isinstance(sub_data, dict) or (required and not sub_data.get(required)):
+            failed[item_id] = f'Missing {required or "data"}'
+            continue
+        if store_error:
+            failed[item_id] = store_error
+            continue
+        forwarded.append({'id': item_id, 'event': event, 'data': sub_data})
+    if not forwarded:
+        emit('batch_data', {'batch_id': batch_id, 'results': build_batch_results(items, failed, {})})
+        return
+    if not add_pending_request(client_sid, 'batch', store_code, key=batch_id, extra=(items, failed)):
+        return
+    print(f'API: forwarding batch {batch_id} ({len(forwarded)}/{len(items)} requests) to store {store_code}')
+    socketio.emit('batch', {'client_sid': client_sid, 'batch_id': batch_id, 'requests': forwarded}, room=store_sid)
+
+def build_batch_results(items, failed, answered, missing_error='No response from store'):
+    """Combine relay-side failures and store answers into one result per sub-request, in request order"""
+    results = []
+    for item_id, event in items:
+        if item_id in failed:
+            results.append({'id': item_id, 'event': event, 'success': False, 'error': failed[item_id]})
+            continue
+        answer = answered.get(item_id)
+        if answer is None:
+            results.append({'id': item_id, 'event': event, 'success': False, 'error': missing_error})
+        elif answer.get('error'):
+            results.append({'id': item_id, 'event': event, 'success': False, 'error': answer.get('error')})
+        else:
+            results.append({'id': item_id, 'event': event, 'success': True, 'data': answer.get('data')})
+    return results
+
+@socketio.on('batch_data')
+def handle_batch_data(data):
+    # data: {'client_sid': ..., 'batch_id': ..., 'results': [{'id': ..., 'data': ...} | {'id': ..., 'error': ...}]}
+    update_activity_for_session()
+    data = data or {}
+    client_sid = data.get('client_sid')
+    batch_id = data.get('batch_id')
+    _, req = pop_pending_request('batch', client_sid=client_sid, key=batch_id) if client_sid else (None, None)
+    if req is None:
+        print(f'API: batch_data for unknown batch {batch_id}, client_sid={client_sid}')
+        return
+    items, failed = req.extra
+    answered = {}
+    for result in data.get('results') or []:
+        if isinstance(result, dict) and 'id' in result:
+            answered[result['id']] = result
+    error = data.get('error')
+    results = build_batch_results(items, failed, answered, error or 'No response from store')
+    response = {'batch_id': batch_id, 'results': results}
+    if error:
+        response['error'] = error
+    socketio.emit('batch_data', response, room=client_sid)
 
 @socketio.on('disconnect')
-def handle_disconnect():
+def handle_disconnect(reason=None):
     # INSTANT detection of disconnect - Socket.IO tells us immediately when connection is lost
     sid = request.sid
     for store_code, store_sid in list(store_sessions.items()):
         if store_sid == sid:
             try:
                 del store_sessions[store_code]
+                reset_vente_inflight(store_code)
+                fail_store_pending_requests(store_code, 'Store backend disconnected')
                 if store_code in store_last_activity:
                     del store_last_activity[store_code]
-                # INSTANT update to OFFLINE - no timeout needed
-                try:
-                    conn = get_api_db_connection()
-                    with conn.cursor() as cursor:
-                        sql = "UPDATE stores SET status='OFFLINE' WHERE store_code=%s"
-                        cursor.execute(sql, (store_code,))
-                        conn.commit()
-                    conn.close()
-                    print(f"Store {store_code} disconnected - status set to OFFLINE instantly")
-                except Exception as e:
-                    print(f"Error updating store status to OFFLINE: {e}")
+                # OFFLINE unless the backend reconnects within the debounce window
+                set_store_presence(store_code, False)
+                print(f"Store {store_code} disconnected")
             except Exception as e:
                 print(f"Error removing store session for {store_code}: {e}")
     if sid in client_sessions:
@@ -882,8 +1871,9 @@ def handle_disconnect():
     if sid in pending_logins:
         del pending_logins[sid]
     # Clean up pending stock requests
-    if sid in pending_requests:
-        del pending_requests[sid]
+    pending_requests.pop(sid, None)
+    clear_stoc_search(sid)
+    clear_snapshot_streams(sid)
 
 @socketio.on('test_event')
 def handle_test_event(data):
@@ -911,6 +1901,184 @@ def update_activity_for_session():
             update_store_activity(store_code)
             break
 
+# --- PRESENCE ---
+# Store ONLINE/OFFLINE changes are debounced: within PRESENCE_DEBOUNCE_WINDOW only the final state
+# is written to the database and broadcast to the clients of the store.
+PRESENCE_DEBOUNCE_WINDOW = float(os.environ.get('PRESENCE_DEBOUNCE_WINDOW', 2.0))  # seconds
+presence_state = {}  # store_code: 'ONLINE' | 'OFFLINE' as last published
+presence_target = {}  # store_code: state to publish when the debounce window closes
+
+def backend_room(store_code):
+    return f'backend:{store_code}'
+
+def set_store_presence(store_code, online):
+    state = 'ONLINE' if online else 'OFFLINE'
+    if store_code not in presence_target:
+        gevent.spawn_later(PRESENCE_DEBOUNCE_WINDOW, publish_store_presence, store_code)
+    presence_target[store_code] = state
+
+def publish_store_presence(store_code):
+    state = presence_target.pop(store_code, None)
+    if state is None or presence_state.get(store_code) == state:
+        return
+    presence_state[store_code] = state
+    try:
+        conn = get_api_db_connection()
+        with conn.cursor() as cursor:
+            sql = "UPDATE stores SET status=%s WHERE store_code=%s"
+            cursor.execute(sql, (state, store_code))
+            conn.commit()
+        conn.close()
+    except Exception as e:
+        print(f"Error updating store status to {state}: {e}")
+    event = 'store_online' if state == 'ONLINE' else 'store_offline'
+    socketio.emit(event, {'store_code': store_code}, room=store_code)
+    print(f"Store {store_code} is now {state}")
+
+# --- STORE HEALTH ---
+# Per-store circuit breaker fed by the latency of answered requests and by requests that time out.
+# Open: requests fail fast. After BREAKER_COOLDOWN it goes half-open and lets one probe through per
+# STORE_REQUEST_TIMEOUT; a good answer closes it, a bad one reopens it. Latency is tracked per request
+# class (bulk list/snapshot reads and batches vs lookups and writes) against its own target. Bulk requests are shed
+# first while the health score is below STORE_SHED_BELOW, except one per BREAKER_COOLDOWN that keeps
+# measuring, so the score recovers without waiting for other traffic.
+STORE_REQUEST_TIMEOUT = float(os.environ.get('STORE_REQUEST_TIMEOUT', 20))  # seconds before a pending request fails
+BREAKER_WINDOW = int(os.environ.get('BREAKER_WINDOW', 20))  # outcomes remembered per store
+BREAKER_MIN_SAMPLES = int(os.environ.get('BREAKER_MIN_SAMPLES', 5))
+BREAKER_FAILURE_RATE = float(os.environ.get('BREAKER_FAILURE_RATE', 0.5))  # opens at or above this
+BREAKER_COOLDOWN = float(os.environ.get('BREAKER_COOLDOWN', 10))  # seconds open before probing
+# Per request class: latency scoring 1.0, and slower answers count as failures
+BREAKER_TARGET_LATENCY = {
+    'lookup': float(os.environ.get('BREAKER_TARGET_LATENCY', 1)),
+    'bulk': float(os.environ.get('BREAKER_BULK_TARGET_LATENCY', 3)),
+}
+BREAKER_SLOW_SECONDS = {
+    'lookup': float(os.environ.get('BREAKER_SLOW_SECONDS', 5)),
+    'bulk': float(os.environ.get('BREAKER_BULK_SLOW_SECONDS', 15)),
+}
+STORE_SHED_BELOW = float(os.environ.get('STORE_SHED_BELOW', 0.5))
+# Bulk list/snapshot reads; shed before lookups and writes
+LOW_PRIORITY_TYPES = {'snapshot', 'products', 'clients', 'sales', 'vendeurs', 'clients_list', 'get_treasury',
+                      'fournisseurs', 'factures_achat', 'factures_vente'}
+# A batch may hold lookups and writes so it is never shed, but it answers many requests at once
+BULK_LATENCY_TYPES = LOW_PRIORITY_TYPES | {'batch'}
+
+def request_class(type_name):
+    return 'bulk' if type_name in BULK_LATENCY_TYPES else 'lookup'
+
+class StoreBreaker(object):
+    """Circuit breaker and health score for one store backend"""
+
+    def __init__(self):
+        self.state = 'closed'
+        self.outcomes = collections.deque(maxlen=BREAKER_WINDOW)  # True for a timely answer
+        self.ewma_latency = {}  # request class: EWMA seconds
+        self.opened_at = 0.0
+        self.last_probe_at = 0.0
+        self.last_shed_probe_at = 0.0
+
+    def failure_rate(self):
+        return (self.outcomes.count(False) / len(self.outcomes)) if self.outcomes else 0.0
+
+    def health(self):
+        if self.state == 'open':
+            return 0.0
+        latency_factor = min([1.0] + [BREAKER_TARGET_LATENCY[cls] / latency
+                                      for cls, latency in self.ewma_latency.items() if latency])
+        score = (1.0 - self.failure_rate()) * latency_factor
+        return min(score, 0.25) if self.state == 'half_open' else score
+
+    def record(self, type_name, answered, latency):
+        cls = request_class(type_name)
+        ok = answered and latency <= BREAKER_SLOW_SECONDS[cls]
+        previous = self.ewma_latency.get(cls)
+        self.ewma_latency[cls] = latency if previous is None else 0.8 * previous + 0.2 * latency
+        self.outcomes.append(ok)
+        if self.state == 'half_open':
+            if ok:
+                self.state = 'closed'
+                self.outcomes.clear()
+            else:
+                self.trip()
+        elif self.state == 'closed' and len(self.outcomes) >= BREAKER_MIN_SAMPLES \
+                and self.failure_rate() >= BREAKER_FAILURE_RATE:
+            self.trip()
+
+    def trip(self):
+        self.state = 'open'
+        self.opened_at = time.time()
+
+    def allow(self):
+        now = time.time()
+        if self.state == 'open' and now - self.opened_at >= BREAKER_COOLDOWN:
+            self.state = 'half_open'
+            self.last_probe_at = 0.0
+        if self.state == 'half_open':
+            if now - self.last_probe_at < STORE_REQUEST_TIMEOUT:
+                return False
+            self.last_probe_at = now
+            return True
+        return self.state == 'closed'
+
+store_breakers = {}  # store_code: StoreBreaker
+
+def get_store_breaker(store_code):
+    breaker = store_breakers.get(store_code)
+    if breaker is None:
+        breaker = store_breakers[store_code] = StoreBreaker()
+    return breaker
+
+def check_store_admission(store_code, type_name):
+    """Return an error message if a request of this type must not be sent to the store now, else None"""
+    breaker = get_store_breaker(store_code)
+    if type_name in LOW_PRIORITY_TYPES and breaker.state == 'closed' and breaker.health() < STORE_SHED_BELOW:
+        if time.time() - breaker.last_shed_probe_at < BREAKER_COOLDOWN:
+            return 'Store backend overloaded, try again later'
+        breaker.last_shed_probe_at = time.time()
+    if not breaker.allow():
+        return 'Store backend not responding, try again later'
+    return None
+
+def expire_pending_requests():
+    """Fail requests the store has not answered within STORE_REQUEST_TIMEOUT and count them against it"""
+    while True:
+        gevent.sleep(1)
+        try:
+            cutoff = time.time() - STORE_REQUEST_TIMEOUT
+            for client_sid, reqs in list(pending_requests.items()):
+                expired = [req for req in reqs if req.sent_at < cutoff]
+                for req in expired:
+                    reqs.remove(req)
+                    get_store_breaker(req.store_code).record(req.type, False, time.time() - req.sent_at)
+                    send_pending_error(client_sid, req, 'Store backend timeout')
+                if not reqs:
+                    pending_requests.pop(client_sid, None)
+        except Exception as e:
+            print(f"Error expiring pending requests: {e}")
+
+@app.route('/admin/store_health')
+def get_store_health():
+    """Circuit breaker state, health score and latency per store"""
+    if not admin_authorized():
+        return jsonify({'error': 'Forbidden'}), 403
+    pending_by_store = collections.Counter(req.store_code for reqs in pending_requests.values() for req in reqs)
+    return jsonify({store_code: {
+        'connected': store_code in store_sessions,
+        'state': breaker.state,
+        'health': round(breaker.health(), 3),
+        'failure_rate': round(breaker.failure_rate(), 3),
+        'ewma_latency_seconds': {cls: round(latency, 3) for cls, latency in breaker.ewma_latency.items()},
+        'pending_requests': pending_by_store.get(store_code, 0),
+        'snapshot_rows_per_second': round(snapshot_store_rates.get(store_code, 0), 1),
+    } for store_code, breaker in store_breakers.items()})
+
+def get_store_code_for_sid(sid):
+    """Return the store_code whose backend uses this sid, or None"""
+    for store_code, store_sid in store_sessions.items():
+        if store_sid == sid:
+            return store_code
+    return None
+
 def check_store_connections():
     """Periodically check if store sessions are still alive and update database status"""
     while True:
@@ -923,41 +2091,318 @@ def check_store_connections():
                 store_sid = store_sessions.get(store_code)
                 if not store_sid:
                     continue
-                
-                    # Use activity timeout as backup - Socket.IO disconnect event handles instant detection
-                    # Check every 10 seconds, timeout after 60 seconds of no activity
-                    last_activity = store_last_activity.get(store_code, 0)
-                    if last_activity == 0:
-                        # Store just registered, initialize with current time
-                        store_last_activity[store_code] = current_time
-                        continue
-                    
-                    time_since_activity = current_time - last_activity
-                    
-                    # 60 seconds timeout - if no activity for 60s, mark offline
-                    # Heartbeats every 5s should keep this updated, so 60s means truly dead
-                    if time_since_activity > 60:
-                        # Double-check: only mark offline if store_sid still exists (session might have been cleaned up)
-                        if store_code in store_sessions and store_sessions[store_code] == store_sid:
-                            print(f"Store {store_code} has no activity in {time_since_activity:.1f} seconds, marking as offline")
-                            if store_code in store_sessions:
-                                del store_sessions[store_code]
-                            if store_code in store_last_activity:
-                                del store_last_activity[store_code]
-                            try:
-                                conn = get_api_db_connection()
-                                with conn.cursor() as cursor:
-                                    sql = "UPDATE stores SET status='OFFLINE' WHERE store_code=%s"
-                                    cursor.execute(sql, (store_code,))
-                                    conn.commit()
-                                conn.close()
-                            except Exception as db_error:
-                                print(f"Error updating store status to OFFLINE: {db_error}")
+
+                # Use activity timeout as backup - Socket.IO disconnect event handles instant detection
+                # Check every 10 seconds, timeout after 60 seconds of no activity
+                last_activity = store_last_activity.get(store_code, 0)
+                if last_activity == 0:
+                    # Store just registered, initialize with current time
+                    store_last_activity[store_code] = current_time
+                    continue
+
+                time_since_activity = current_time - last_activity
+
+                # 60 seconds timeout - if no activity for 60s, mark offline
+                # Heartbeats every 5s should keep this updated, so 60s means truly dead
+                if time_since_activity > 60:
+                    # Double-check: only mark offline if store_sid still exists (session might have been cleaned up)
+                    if store_code in store_sessions and store_sessions[store_code] == store_sid:
+                        print(f"Store {store_code} has no activity in {time_since_activity:.1f} seconds, marking as offline")
+                        del store_sessions[store_code]
+                        reset_vente_inflight(store_code)
+                        fail_store_pending_requests(store_code, 'Store backend disconnected')
+                        if store_code in store_last_activity:
+                            del store_last_activity[store_code]
+                        set_store_presence(store_code, False)
+                        # Drop the socket too, so a backend that is still alive reconnects and re-registers
+                        socketio.server.disconnect(store_sid)
         except Exception as e:
             print(f"Error in store connection check: {e}")
 
-# Start background task to check store connections
+# --- PROFILING ---
+# Hub-blocking detector, per-handler CPU/wall counters and an on-demand sampling profiler.
+# PROFILING=1 installs the greenlet switch tracer and handler wrappers; without it /admin/hub_blocks and
+# /admin/handler_stats stay empty, while /admin/profile sampling works either way.
+PROFILING_ENABLED = os.environ.get('PROFILING', '0') == '1'
+HUB_BLOCK_THRESHOLD = float(os.environ.get('HUB_BLOCK_THRESHOLD', 0.1))  # seconds
+MAIN_THREAD_IDENT = gevent.monkey.get_original('_thread', 'get_ident')()
+hub_blocks = collections.deque(maxlen=100)  # most recent blocking reports
+handler_stats = {}  # event: {'calls', 'errors', 'wall_seconds', 'cpu_seconds', 'max_wall_seconds'}
+greenlet_events = {}  # greenlet: Socket.IO event it is currently handling
+greenlet_cpu = {}  # greenlet: [cpu seconds so far, thread_time when last switched in]
+_previous_greenlet_tracer = None
+
+def trace_greenlet_switch(event, args):
+    """greenlet.settrace hook: charge thread CPU time to the handler greenlet that used it"""
+    if event in ('switch', 'throw'):
+        origin, target = args
+        if origin in greenlet_cpu or target in greenlet_cpu:
+            now = time.thread_time()
+            if origin in greenlet_cpu:
+                greenlet_cpu[origin][0] += now - greenlet_cpu[origin][1]
+            if target in greenlet_cpu:
+                greenlet_cpu[target][1] = now
+    if _previous_greenlet_tracer is not None:
+        _previous_greenlet_tracer(event, args)
+
+def profiled_handler(event, handler):
+    @functools.wraps(handler)
+    def _profiled(*args):
+        current = greenlet.getcurrent()
+        greenlet_events[current] = event
+        greenlet_cpu[current] = [0.0, time.thread_time()]
+        started = time.time()
+        failed = False
+        try:
+            return handler(*args)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            wall = time.time() - started
+            cpu, resumed_at = greenlet_cpu.pop(current)
+            cpu += time.thread_time() - resumed_at
+            greenlet_events.pop(current, None)
+            stats = handler_stats.setdefault(event, {'calls': 0, 'errors': 0, 'wall_seconds': 0.0,
+                                                     'cpu_seconds': 0.0, 'max_wall_seconds': 0.0})
+            stats['calls'] += 1
+            stats['errors'] += failed
+            stats['wall_seconds'] += wall
+            stats['cpu_seconds'] += cpu
+            stats['max_wall_seconds'] = max(stats['max_wall_seconds'], wall)
+    return _profiled
+
+def record_hub_block(event):
+    """gevent event subscriber; runs in gevent's monitor thread"""
+    if not isinstance(event, gevent.events.EventLoopBlocked):
+        return
+    socketio_event = greenlet_events.get(event.greenlet)
+    hub_blocks.append({
+        'time': time.time(),
+        'event': socketio_event,
+        'greenlet': repr(event.greenlet),
+        'threshold_seconds': event.blocking_time,
+        'report': list(event.info),
+    })
+    print(f"Hub blocked > {event.blocking_time}s by {event.greenlet!r} (event: {socketio_event})")
+
+def start_profiling():
+    """Wrap every registered Socket.IO handler and start gevent's hub monitor thread once the hub runs"""
+    global _previous_greenlet_tracer
+    handlers = socketio.server.handlers.get('/', {})
+    for event, handler in list(handlers.items()):
+        handlers[event] = profiled_handler(event, handler)
+    gevent.config.monitor_thread = True
+    gevent.config.max_blocking_time = HUB_BLOCK_THRESHOLD
+    gevent.config.print_blocking_reports = False
+    gevent.events.subscribers.append(record_hub_block)
+    # The monitor's own tracer chains to this one when it starts
+    _previous_greenlet_tracer = greenlet.settrace(trace_greenlet_switch)
+    # Started at import the monitor sees a hub that has not run yet, takes it for dead and stops
+    gevent.spawn(start_hub_monitor)
+
+def hub_monitor_running():
+    monitor = gevent.get_hub().periodic_monitoring_thread
+    return bool(monitor is not None and monitor.should_run)
+
+def start_hub_monitor():
+    gevent.get_hub().start_periodic_monitoring_thread()
+    if not hub_monitor_running():
+        print("WARNING: gevent hub monitor is not running; /admin/hub_blocks will stay empty")
+
+def sample_main_thread(seconds, interval):
+    """Runs in a real thread: sample the hub thread's stack and count collapsed stacks"""
+    real_sleep = gevent.monkey.get_original('time', 'sleep')
+    counts = collections.Counter()
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        frame = sys._current_frames().get(MAIN_THREAD_IDENT)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+            frame = frame.f_back
+        if stack:
+            counts[';'.join(reversed(stack))] += 1
+        real_sleep(interval)
+    return counts
+
+@app.route('/admin/profile')
+def get_profile():
+    """Sample the hub for ?seconds= (max 60) and return flame-graph data in collapsed-stack format"""
+    if not admin_authorized():
+        return jsonify({'error': 'Forbidden'}), 403
+    try:
+        seconds = min(float(request.args.get('seconds', 5)), 60.0)
+        interval = max(float(request.args.get('interval', 0.005)), 0.001)
+    except ValueError:
+        return jsonify({'error': 'Invalid seconds or interval'}), 400
+    counts = gevent.get_hub().threadpool.apply(sample_main_thread, (seconds, interval))
+    folded = '\n'.join(f'{stack} {count}' for stack, count in counts.most_common())
+    return app.response_class(folded + '\n', mimetype='text/plain')
+
+@app.route('/admin/hub_blocks')
+def get_hub_blocks():
+    """Recent greenlets that blocked the hub longer than HUB_BLOCK_THRESHOLD, with their stacks"""
+    if not admin_authorized():
+        return jsonify({'error': 'Forbidden'}), 403
+    return jsonify({'threshold_seconds': HUB_BLOCK_THRESHOLD, 'monitor_running': hub_monitor_running(),
+                    'blocks': list(hub_blocks)})
+
+@app.route('/admin/handler_stats')
+def get_handler_stats():
+    """Per Socket.IO event call counts with cumulative wall and CPU time"""
+    if not admin_authorized():
+        return jsonify({'error': 'Forbidden'}), 403
+    return jsonify(handler_stats)
+
+if PROFILING_ENABLED:
+    start_profiling()
+
+# --- MEMORY ---
+# TRACEMALLOC=<frames> enables allocation tracing for /admin/memory (costs memory and CPU while on)
+TRACEMALLOC_FRAMES = int(os.environ.get('TRACEMALLOC', 0))
+if TRACEMALLOC_FRAMES:
+    tracemalloc.start(TRACEMALLOC_FRAMES)
+
+def deep_sizeof(obj, seen=None):
+    """Bytes held by obj and everything it references through containers and __slots__, each object once"""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, collections.deque)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    elif hasattr(obj, '__slots__'):
+        size += sum(deep_sizeof(getattr(obj, name), seen) for name in obj.__slots__ if hasattr(obj, name))
+    return size
+
+@app.route('/admin/memory')
+def get_memory():
+    """Memory held by session and pending-request state, plus top allocation sites when tracemalloc is on"""
+    if not admin_authorized():
+        return jsonify({'error': 'Forbidden'}), 403
+    # Interned store codes are shared, so measure everything against one seen-set to avoid double counting
+    seen = set()
+    state = {
+        'client_sessions': (len(client_sessions), deep_sizeof(client_sessions, seen)),
+        'store_sessions': (len(store_sessions), deep_sizeof(store_sessions, seen)),
+        'pending_requests': (sum(len(reqs) for reqs in pending_requests.values()), deep_sizeof(pending_requests, seen)),
+        'pending_logins': (len(pending_logins), deep_sizeof(pending_logins, seen)),
+        'store_last_activity': (len(store_last_activity), deep_sizeof(store_last_activity, seen)),
+        'store_index': (len(store_index), deep_sizeof(store_index, seen)),
+        'vente_journal': (len(vente_journal), deep_sizeof(vente_journal, seen)),
+    }
+    result = {
+        'state': {name: {'entries': entries, 'bytes': size} for name, (entries, size) in state.items()},
+        'bytes_per_client': (state['client_sessions'][1] + state['pending_requests'][1]) / len(client_sessions)
+                            if client_sessions else 0,
+        'tracemalloc': None,
+    }
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(True, __file__)])
+        result['tracemalloc'] = {
+            'current_bytes': current,
+            'peak_bytes': peak,
+            'app_bytes': sum(stat.size for stat in snapshot.statistics('filename')),
+            'top': [{'where': str(stat.traceback[0]), 'bytes': stat.size, 'blocks': stat.count}
+                    for stat in snapshot.statistics('lineno')[:20]],
+        }
+    return jsonify(result)
+
+# --- TRAFFIC CAPTURE ---
+# Opt-in recorder of every inbound and outbound Socket.IO event, replayable with replay_traffic.py
+TRAFFIC_CAPTURE_PATH = os.environ.get('TRAFFIC_CAPTURE_PATH', '')
+TRAFFIC_CAPTURE_PAYLOADS = os.environ.get('TRAFFIC_CAPTURE_PAYLOADS', 'redacted')  # full | redacted | none
+TRAFFIC_CAPTURE_MAX_BYTES = int(os.environ.get('TRAFFIC_CAPTURE_MAX_BYTES', 1 << 30))
+traffic_capture_file = None
+traffic_capture_bytes = 0
+
+def classify_sid(sid):
+    """Return (role, store_code) for a sid or room name"""
+    store_code = get_store_code_for_sid(sid)
+    if store_code:
+        return traffic_capture.ROLE_STORE, store_code
+    if sid in client_sessions:
+        return traffic_capture.ROLE_CLIENT, client_sessions[sid]
+    return traffic_capture.ROLE_OTHER, None
+
+def capture_event(direction, role, timestamp, event, sid, store_code, payload):
+    global traffic_capture_file, traffic_capture_bytes
+    if traffic_capture_file is None or traffic_capture_bytes >= TRAFFIC_CAPTURE_MAX_BYTES:
+        return
+    try:
+        record = traffic_capture.encode_record(direction, role, timestamp, event, sid, store_code, payload,
+                                               TRAFFIC_CAPTURE_PAYLOADS)
+        traffic_capture_file.write(record)
+        traffic_capture_bytes += len(record)
+        if traffic_capture_bytes >= TRAFFIC_CAPTURE_MAX_BYTES:
+            traffic_capture_file.flush()
+            print(f"Traffic capture reached {TRAFFIC_CAPTURE_MAX_BYTES} bytes, recording stopped")
+    except Exception as e:
+        print(f"Error capturing {event}: {e}")
+
+def captured_handler(event, handler):
+    @functools.wraps(handler)
+    def _captured(sid, *args):
+        received = time.time()
+        role, store_code = classify_sid(sid)
+        try:
+            return handler(sid, *args)
+        finally:
+            if role == traffic_capture.ROLE_OTHER:
+                # Registration events: the role is only known once the handler has run
+                role, store_code = classify_sid(sid)
+            payload = args[0] if args else None
+            capture_event(traffic_capture.INBOUND, role, received, event, sid, store_code, payload)
+    return _captured
+
+def start_traffic_capture():
+    """Wrap every Socket.IO handler and the server's emit so both directions are recorded"""
+    global traffic_capture_file
+    traffic_capture_file = open(TRAFFIC_CAPTURE_PATH, 'ab')
+    if traffic_capture_file.tell() == 0:
+        traffic_capture_file.write(traffic_capture.MAGIC)
+    handlers = socketio.server.handlers.get('/', {})
+    for event, handler in list(handlers.items()):
+        handlers[event] = captured_handler(event, handler)
+    server_emit = socketio.server.emit
+
+    @functools.wraps(server_emit)
+    def _captured_emit(event, *args, **kwargs):
+        to = kwargs.get('to') or kwargs.get('room')
+        role, store_code = classify_sid(to)
+        if role == traffic_capture.ROLE_OTHER and (to in store_sessions or to in presence_state):
+            store_code = to  # broadcast to the clients room of a store
+        payload = args[0] if args else kwargs.get('data')
+        capture_event(traffic_capture.OUTBOUND, role, time.time(), event, to, store_code, payload)
+        return server_emit(event, *args, **kwargs)
+    socketio.server.emit = _captured_emit
+    gevent.spawn(flush_traffic_capture)
+    print(f"Traffic capture enabled: {TRAFFIC_CAPTURE_PATH} (payloads: {TRAFFIC_CAPTURE_PAYLOADS})")
+
+def flush_traffic_capture():
+    while True:
+        gevent.sleep(1)
+        try:
+            traffic_capture_file.flush()
+        except Exception as e:
+            print(f"Error flushing traffic capture: {e}")
+
+if TRAFFIC_CAPTURE_PATH:
+    start_traffic_capture()
+
+# Preload store metadata and restore queued sales from the journal, then start background tasks
+warm_start()
+gevent.spawn(refresh_store_index)
+load_vente_journal()
+gevent.spawn(vente_journal_maintenance)
 gevent.spawn(check_store_connections)
+gevent.spawn(expire_pending_requests)
 
 if __name__ == '__main__':
     socketio.run(app, host='0.0.0.0', port=5000) 
@@ -0,0 +1,269 @@
+"""Replay a relay traffic capture against a local app.py with fake store backends.
+
+Record on the relay with TRAFFIC_CAPTURE_PATH=capture.bin, then run for example:
+
+    python replay_traffic.py capture.bin --url http://localhost:5000 --speed 10 --auth-code S001=secret
+
+Every store seen in the capture gets a fake backend that registers with the given auth code and
+answers each request with the recorded response (or a padded stand-in of the recorded size) after
+the recorded backend delay. Every client session is replayed with its original timing divided by
+--speed (0 sends as fast as possible); sessions that began with resume_session register with
+register_client instead, since recorded tickets cannot be verified by another relay. Per-event
+response latencies of answered requests are printed at the end, followed by unanswered counts.
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import collections
+import time
+
+import gevent
+import gevent.event
+import socketio
+
+import traffic_capture
+
+# Event the relay sends to a store backend: event the backend answers with
+STORE_RESPONSES = {
+    'login_request': 'login_response',
+    'get_usernames_request': 'usernames_list_response',
+    'get_products': 'products_data',
+    'get_product_by_barcode': 'product_by_barcode_data',
+    'get_product_details': 'product_details_data',
+    'get_clients': 'clients_data',
+    'get_sales': 'sales_data',
+    'get_sale_details': 'sale_details_data',
+    'get_vendeurs': 'vendeurs_data',
+    'get_clients_list': 'clients_list_data',
+    'get_treasury': 'treasury_data',
+    'get_fournisseurs': 'fournisseurs_data',
+    'get_factures_achat': 'factures_achat_data',
+    'get_facture_achat_details': 'facture_achat_details_data',
+    'get_factures_vente': 'factures_vente_data',
+    'get_facture_vente_details': 'facture_vente_details_data',
+    'get_stoc_entries': 'stoc_entries_data',
+    'get_snapshot_table': 'snapshot_table_data',
+    'save_vente': 'save_vente_response',
+    'batch': 'batch_data',
+}
+# Event a client sends: event the relay answers with
+CLIENT_RESPONSES = {
+    'register_client': 'register_client_response',
+    'login': 'login_result',
+    'resume_session': 'login_result',
+    'get_usernames': 'usernames_list',
+    'get_products': 'products_data',
+    'get_product_by_barcode': 'product_by_barcode_data',
+    'get_product_details': 'product_details_data',
+    'get_clients': 'clients_data',
+    'get_sales': 'sales_data',
+    'get_sale_details': 'sale_details_data',
+    'get_vendeurs': 'vendeurs_data',
+    'get_clients_list': 'clients_list_data',
+    'get_treasury': 'treasury_data',
+    'get_fournisseurs': 'fournisseurs_data',
+    'get_factures_achat': 'factures_achat_data',
+    'get_facture_achat_details': 'facture_achat_details_data',
+    'get_factures_vente': 'factures_vente_data',
+    'get_facture_vente_details': 'facture_vente_details_data',
+    'get_stoc_entries': 'stoc_entries_data',
+    'get_snapshot_table': 'snapshot_table_data',
+    'save_vente': 'save_vente_response',
+    'batch': 'batch_data',
+}
+# Fields the relay uses to route a backend answer, copied from the live request into the replayed answer
+ROUTING_FIELDS = ('client_sid', 'batch_id', 'table', 'offset', 'limit', 'idempotency_key', 'seq', 'term',
+                  'relay_request_id')
+SKIPPED_CLIENT_EVENTS = ('disconnect', 'connect')
+
+
+def load_capture(path):
+    """Split a capture into per-sid client scripts and per-store backend answer scripts"""
+    clients = collections.OrderedDict()  # sid: {'store_code', 'events': [(timestamp, event, payload)], 'end'}
+    stores = {}  # store_code: {response event: deque([(payload, size, delay)])}
+    requested = collections.defaultdict(collections.deque)  # (store_code, response event): request timestamps
+    start = None
+    for rec in traffic_capture.read_records(path):
+        if start is None:
+            start = rec['timestamp']
+        if rec['role'] == traffic_capture.ROLE_STORE:
+            store_code = rec['store_code']
+            script = stores.setdefault(store_code, collections.defaultdict(collections.deque))
+            if rec['direction'] == traffic_capture.OUTBOUND and rec['event'] in STORE_RESPONSES:
+                requested[(store_code, STORE_RESPONSES[rec['event']])].append(rec['timestamp'])
+            elif rec['direction'] == traffic_capture.INBOUND and rec['event'] in STORE_RESPONSES.values():
+                asked = requested[(store_code, rec['event'])]
+                delay = rec['timestamp'] - asked.popleft() if asked else 0.0
+                script[rec['event']].append((rec['payload'], rec['size'], max(delay, 0.0)))
+        elif rec['direction'] == traffic_capture.INBOUND:
+            session = clients.setdefault(rec['sid'], {'store_code': rec['store_code'], 'events': [], 'end': None})
+            session['store_code'] = session['store_code'] or rec['store_code']
+            if rec['event'] == 'disconnect':
+                session['end'] = rec['timestamp']
+            elif rec['event'] not in SKIPPED_CLIENT_EVENTS:
+                session['events'].append((rec['timestamp'], rec['event'], rec['payload']))
+    return start or 0.0, clients, stores
+
+
+def stand_in_payload(size, success=True):
+    """Payload of roughly the recorded size when the capture kept no payload"""
+    return {'success': success, 'padding': 'x' * max(size - 40, 0)}
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+class FakeStore(object):
+    """Store backend answering relay requests from a recorded script"""
+
+    def __init__(self, url, store_code, auth_code, script, speed):
+        self.store_code = store_code
+        self.auth_code = auth_code
+        self.script = script
+        self.speed = speed
+        self.registered = gevent.event.Event()
+        self.sio = socketio.Client(reconnection=False)
+        self.sio.on('register_store_response', self.on_registered)
+        for request_event, response_event in STORE_RESPONSES.items():
+            self.sio.on(request_event, self.make_handler(response_event))
+        self.url = url
+
+    def start(self):
+        self.sio.connect(self.url, transports=['websocket'])
+        self.sio.emit('register_store', {'store_code': self.store_code, 'auth_code': self.auth_code})
+        gevent.spawn(self.heartbeat)
+
+    def on_registered(self, data):
+        if not data.get('success'):
+            print(f"Fake store {self.store_code} failed to register: {data.get('error')}")
+        self.registered.set()
+
+    def heartbeat(self):
+        while self.sio.connected:
+            self.sio.emit('heartbeat', {})
+            gevent.sleep(5)
+
+    def make_handler(self, response_event):
+        def handler(data):
+            gevent.spawn(self.answer, response_event, data or {})
+        return handler
+
+    def answer(self, response_event, request):
+        recorded = self.script[response_event]
+        payload, size, delay = recorded.popleft() if recorded else (None, 0, 0.0)
+        if payload is None:
+            payload = stand_in_payload(size)
+        payload = dict(payload) if isinstance(payload, dict) else {'data': payload}
+        for field in ROUTING_FIELDS:
+            if field in request:
+                payload[field] = request[field]
+        if response_event == 'batch_data':
+            answered = {r.get('id') for r in payload.get('results') or [] if isinstance(r, dict)}
+            payload['results'] = [r for r in payload.get('results') or [] if isinstance(r, dict)] + [
+                {'id': r.get('id'), 'data': {}} for r in request.get('requests') or [] if r.get('id') not in answered]
+        if self.speed:
+            gevent.sleep(delay / self.speed)
+        self.sio.emit(response_event, payload)
+
+
+class ReplayClient(object):
+    """One recorded client session, measuring the latency of every answered request"""
+
+    def __init__(self, url, session, latencies, unanswered):
+        self.url = url
+        self.session = session
+        self.latencies = latencies
+        self.unanswered = unanswered
+        self.waiting = collections.defaultdict(collections.deque)  # response event: deque([(request event, sent at)])
+        self.sio = socketio.Client(reconnection=False)
+        self.sio.on('*', self.on_event)
+
+    def on_event(self, event, data=None):
+        waiting = self.waiting.get(event)
+        if event == 'save_vente_queued':
+            # The journaled save is acknowledged before the store answers
+            waiting = self.waiting.get('save_vente_response')
+        if waiting:
+            request_event, sent_at = waiting.popleft()
+            self.latencies[request_event].append(time.time() - sent_at)
+
+    def run(self, speed, drain):
+        events = self.session['events']
+        self.sio.connect(self.url, transports=['websocket'])
+        started = time.time()
+        first = events[0][0]
+        for timestamp, event, payload in events:
+            if speed:
+                gevent.sleep(max(started + (timestamp - first) / speed - time.time(), 0))
+            if event == 'resume_session':
+                # Recorded tickets are redacted or signed with another relay's key; register the session instead
+                event, payload = 'register_client', {'store_code': self.session['store_code']}
+            if payload is None:
+                payload = {'store_code': self.session['store_code']} if event in ('register_client', 'login', 'get_usernames') else {}
+            if event in CLIENT_RESPONSES:
+                self.waiting[CLIENT_RESPONSES[event]].append((event, time.time()))
+            self.sio.emit(event, payload)
+        deadline = time.time() + drain
+        while any(self.waiting.values()) and time.time() < deadline:
+            gevent.sleep(0.05)
+        for queue in self.waiting.values():
+            for request_event, _ in queue:
+                self.unanswered[request_event] += 1
+        self.sio.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('capture')
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--speed', type=float, default=1.0, help='time compression factor, 0 for no pauses')
+    parser.add_argument('--auth-code', action='append', default=[], metavar='STORE=CODE',
+                        help='auth code of a store in the local database (repeatable)')
+    parser.add_argument('--drain', type=float, default=30.0, help='seconds to wait for outstanding answers')
+    args = parser.parse_args()
+    auth_codes = dict(item.split('=', 1) for item in args.auth_code)
+
+    start, clients, stores = load_capture(args.capture)
+    print(f'Capture: {len(clients)} client sessions, {len(stores)} stores')
+    fake_stores = []
+    for store_code, script in stores.items():
+        if store_code not in auth_codes:
+            print(f'No --auth-code for store {store_code}; its clients will see it offline')
+            continue
+        fake = FakeStore(args.url, store_code, auth_codes[store_code], script, args.speed)
+        fake.start()
+        fake_stores.append(fake)
+    for fake in fake_stores:
+        fake.registered.wait(timeout=10)
+
+    latencies = collections.defaultdict(list)
+    unanswered = collections.Counter()
+    began = time.time()
+    greenlets = []
+    for session in clients.values():
+        if not session['events']:
+            continue
+        offset = (session['events'][0][0] - start) / args.speed if args.speed else 0
+        replay = ReplayClient(args.url, session, latencies, unanswered)
+        greenlets.append(gevent.spawn_later(offset, replay.run, args.speed, args.drain))
+    gevent.joinall(greenlets)
+    elapsed = time.time() - began
+    for fake in fake_stores:
+        fake.sio.disconnect()
+
+    total = sum(len(values) for values in latencies.values())
+    print(f'Replayed {total} answered requests in {elapsed:.2f}s ({total / elapsed if elapsed else 0:.1f} req/s)')
+    print(f"{'event':<40}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for event in sorted(latencies):
+        values = latencies[event]
+        print(f'{event:<40}{len(values):>8}{percentile(values, 0.5) * 1000:>10.1f}'
+              f'{percentile(values, 0.95) * 1000:>10.1f}{percentile(values, 0.99) * 1000:>10.1f}{max(values) * 1000:>10.1f}')
+    if unanswered:
+        print(f'Unanswered after {args.drain:.0f}s: ' + ', '.join(f'{event} {count}' for event, count in sorted(unanswered.items())))
+
+
+if __name__ == '__main__':
+    main()
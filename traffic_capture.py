@@ -0,0 +1,94 @@
+"""Compact binary log of relay Socket.IO traffic, shared by app.py (recording) and replay_traffic.py.
+
+File layout: MAGIC, then one record per event:
+    header  struct RECORD_HEADER (direction, role, flags, timestamp, event/sid/store lengths,
+            original payload size, stored payload length)
+    body    event name, sid (or target room), store_code, stored payload (JSON, maybe zlib)
+"""
+import json
+import struct
+import zlib
+
+MAGIC = b'DVTC\x01'
+RECORD_HEADER = struct.Struct('<BBBdHBBII')
+
+INBOUND = 0  # received by the relay
+OUTBOUND = 1  # emitted by the relay
+
+ROLE_OTHER = 0
+ROLE_CLIENT = 1
+ROLE_STORE = 2
+ROLE_NAMES = {ROLE_OTHER: 'other', ROLE_CLIENT: 'client', ROLE_STORE: 'store'}
+
+FLAG_COMPRESSED = 1
+FLAG_REDACTED = 2
+
+COMPRESS_OVER = 256  # bytes; smaller payloads are stored as plain JSON
+SENSITIVE_KEYS = {'password', 'auth_code', 'ticket', 'session_ticket'}
+
+
+def redact(payload):
+    """Copy of payload with credential values masked, at any depth"""
+    if isinstance(payload, dict):
+        return {k: ('***' if k in SENSITIVE_KEYS else redact(v)) for k, v in payload.items()}
+    if isinstance(payload, list):
+        return [redact(v) for v in payload]
+    return payload
+
+
+def encode_record(direction, role, timestamp, event, sid, store_code, payload, payload_mode='redacted'):
+    """Return the bytes of one record; payload_mode is 'full', 'redacted' or 'none'"""
+    raw = json.dumps(payload, separators=(',', ':'), default=str).encode()
+    flags = 0
+    stored = b''
+    if payload_mode != 'none':
+        if payload_mode == 'redacted':
+            stored = json.dumps(redact(payload), separators=(',', ':'), default=str).encode()
+            flags |= FLAG_REDACTED
+        else:
+            stored = raw
+        if len(stored) > COMPRESS_OVER:
+            stored = zlib.compress(stored, 1)
+            flags |= FLAG_COMPRESSED
+    event_b = (event or '').encode()[:0xFFFF]
+    sid_b = (sid or '').encode()[:0xFF]
+    store_b = (store_code or '').encode()[:0xFF]
+    header = RECORD_HEADER.pack(direction, role, flags, timestamp, len(event_b), len(sid_b), len(store_b),
+                                len(raw), len(stored))
+    return header + event_b + sid_b + store_b + stored
+
+
+def read_records(path):
+    """Yield one dict per record: direction, role, timestamp, event, sid, store_code, size, payload, redacted"""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a traffic capture')
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            direction, role, flags, timestamp, event_len, sid_len, store_len, size, stored_len = RECORD_HEADER.unpack(header)
+            body = f.read(event_len + sid_len + store_len + stored_len)
+            if len(body) < event_len + sid_len + store_len + stored_len:
+                # Truncated tail, e.g. the relay was killed mid-write
+                return
+            event = body[:event_len].decode()
+            sid = body[event_len:event_len + sid_len].decode()
+            store_code = body[event_len + sid_len:event_len + sid_len + store_len].decode()
+            stored = body[event_len + sid_len + store_len:]
+            payload = None
+            if stored:
+                if flags & FLAG_COMPRESSED:
+                    stored = zlib.decompress(stored)
+                payload = json.loads(stored)
+            yield {
+                'direction': direction,
+                'role': role,
+                'timestamp': timestamp,
+                'event': event,
+                'sid': sid,
+                'store_code': store_code,
+                'size': size,
+                'payload': payload,
+                'redacted': bool(flags & FLAG_REDACTED),
+            }